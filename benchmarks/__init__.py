@@ -0,0 +1,5 @@
+# Per-stage micro-benchmarks of the wahzam pipeline on deterministic synthetic audio.
+#
+#   python -m benchmarks --output results.json
+#
+# See `benchmarks.run` for the stages and the JSON output format.
@@ -0,0 +1,190 @@
+# Times each stage of the pipeline separately and reports the results as JSON:
+#
+#   {"environment": {...}, "results": [{"stage": ..., "backend": ..., "params": {...},
+#                                       "seconds": ..., "peak_memory_bytes": ..., ...}, ...]}
+#
+# Audio stages (make_spectogram, local_peak_locations, findsfingerprints/fingerprint_hashes)
+# report "audio_seconds_per_second"; database stages (store_fingerprints, give_matched_songid)
+# run on synthetic databases of random peaks and report songs per second, bytes per song,
+# query latency and accuracy, for the dict, FingerprintIndex ("index") and CompressedIndex
+# ("compressed") backends; the resident bytes of the index backends are also their size on disk.
+#
+# The defaults run in a few minutes; large catalogs are opt-in, e.g.
+#
+#   python -m benchmarks --durations 30 --songs 1000 10000 100000 --song-seconds 10 --output big.json
+
+import argparse
+import json
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from wahzam.databases import CompressedIndex, FingerprintIndex, add_song, give_matched_songid
+from wahzam.find_peaks import local_peak_locations, make_spectogram
+from wahzam.fingerprint import findsfingerprints, fingerprint_hashes, unpack_fingerprints
+
+from .synthetic import synthetic_peaks, synthetic_song
+
+SAMPLING_RATE = 44100
+
+
+def measure(function, repeat = 3):
+    """
+    Runs `function` `repeat` times and once more under tracemalloc
+
+    Returns
+    -------
+    (result, seconds, peak_memory_bytes)
+        the last result, the best wall time and the peak memory allocated during one run
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def audio_stages(duration, repeat = 3, seed = 0):
+    """Benchmarks the audio stages on `duration` seconds of synthetic audio"""
+    samples = synthetic_song(duration, SAMPLING_RATE, seed)
+    results = []
+
+    def record(stage, backend, seconds, peak, **extra):
+        results.append({"stage": stage, "backend": backend, "params": {"duration": duration},
+                        "seconds": seconds, "audio_seconds_per_second": duration / seconds,
+                        "peak_memory_bytes": peak, **extra})
+
+    for dtype in (np.float64, np.float32):
+        spectrogram, seconds, peak = measure(lambda: make_spectogram(samples, dtype = dtype), repeat)
+        record("make_spectogram", np.dtype(dtype).name, seconds, peak, shape = list(spectrogram.shape))
+
+    spectrogram = make_spectogram(samples)
+    for method in ("numba", "max_filter"):
+        local_peak_locations(spectrogram[:, :50], method = method)  # JIT warm-up
+        peaks, seconds, peak = measure(lambda: local_peak_locations(spectrogram, method = method), repeat)
+        record("local_peak_locations", method, seconds, peak, peaks = len(peaks))
+
+    prints, seconds, peak = measure(lambda: findsfingerprints(peaks), repeat)
+    record("fingerprints", "findsfingerprints", seconds, peak, fingerprints = len(prints[0]))
+    hashes, seconds, peak = measure(lambda: fingerprint_hashes(peaks), repeat)
+    record("fingerprints", "fingerprint_hashes", seconds, peak, fingerprints = len(hashes[0]))
+    return results
+
+
+def _song_fingerprints(num_songs, song_seconds, seed):
+    for song in range(num_songs):
+        yield fingerprint_hashes(synthetic_peaks(song_seconds, seed = seed + song))
+
+
+def _query(num_songs, song_seconds, clip_seconds, rng, seed):
+    # the peaks of a random excerpt of a random song, mixed with as many random peaks
+    song = int(rng.integers(num_songs))
+    peaks = synthetic_peaks(song_seconds, seed = seed + song)
+    frames_per_second = SAMPLING_RATE / 2048
+    start = rng.uniform(0, song_seconds - clip_seconds) * frames_per_second
+    excerpt = peaks[(peaks[:, 1] >= start) & (peaks[:, 1] < start + clip_seconds * frames_per_second)]
+    excerpt = excerpt - [0, int(start)]
+    clutter = synthetic_peaks(clip_seconds, seed = int(rng.integers(2 ** 31)))
+    clip = np.concatenate([excerpt, clutter])
+    clip = clip[np.lexsort((clip[:, 0], clip[:, 1]))]
+    return song, fingerprint_hashes(clip)
+
+
+def database_stages(num_songs, backend, song_seconds = 30, clip_seconds = 6, num_queries = 20, seed = 0):
+    """Benchmarks building and querying a synthetic database of `num_songs` songs"""
+    songs = list(_song_fingerprints(num_songs, song_seconds, seed))
+    if backend == "dict":
+        songs = [([tuple(f) for f in unpack_fingerprints(h).tolist()], t.tolist()) for h, t in songs]
+
+    def build():
+        fingerprint_database = {} if backend == "dict" else FingerprintIndex()
+        artist_database = {}
+        for i, (hashes, times) in enumerate(songs):
+            add_song(hashes, times, f"song {i}", "synthetic", artist_database, fingerprint_database)
+        if backend == "index":
+            fingerprint_database.flush()
+        if backend == "compressed":
+            fingerprint_database = CompressedIndex.from_index(fingerprint_database)
+        return fingerprint_database, artist_database
+
+    (fingerprint_database, artist_database), seconds, peak = measure(build, repeat = 1)
+    params = {"songs": num_songs, "song_seconds": song_seconds}
+    if backend == "dict":
+        database_bytes = len(pickle.dumps(fingerprint_database))
+    else:
+        database_bytes = fingerprint_database.nbytes
+    results = [{"stage": "store_fingerprints", "backend": backend, "params": params, "seconds": seconds,
+                "songs_per_second": num_songs / seconds, "peak_memory_bytes": peak,
+                "database_bytes": database_bytes, "database_bytes_per_song": database_bytes / num_songs,
+                "database_bytes_kind": "pickled" if backend == "dict" else "resident"}]
+
+    rng = np.random.default_rng(seed)
+    queries = [_query(num_songs, song_seconds, clip_seconds, rng, seed) for _ in range(num_queries)]
+    if backend == "dict":
+        queries = [(song, ([tuple(f) for f in unpack_fingerprints(h).tolist()], t.tolist())) for song, (h, t) in queries]
+
+    def run_queries():
+        return [give_matched_songid(prints, fingerprint_database, times) for _, (prints, times) in queries]
+
+    matched, seconds, peak = measure(run_queries, repeat = 1)
+    correct = sum(song_id == f"Song{song}" for song_id, (song, _) in zip(matched, queries))
+    results.append({"stage": "give_matched_songid", "backend": backend,
+                    "params": dict(params, clip_seconds = clip_seconds, queries = num_queries),
+                    "seconds": seconds, "seconds_per_query": seconds / num_queries,
+                    "peak_memory_bytes": peak, "accuracy": correct / num_queries})
+    return results
+
+
+def environment():
+    """Python/NumPy versions, platform and git commit the benchmarks ran on"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "commit": commit or None}
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Benchmark each stage of the wahzam pipeline")
+    parser.add_argument("--durations", type = float, nargs = "+", default = [5, 30, 120],
+                        help = "seconds of synthetic audio for the audio stages")
+    parser.add_argument("--songs", type = int, nargs = "+", default = [100, 1000],
+                        help = "sizes of the synthetic databases")
+    parser.add_argument("--song-seconds", type = float, default = 30,
+                        help = "length of each song of the synthetic databases")
+    parser.add_argument("--max-dict-songs", type = int, default = 100,
+                        help = "largest database also benchmarked with the dict backend")
+    parser.add_argument("--queries", type = int, default = 20)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "JSON file to write, stdout by default")
+    args = parser.parse_args(args)
+
+    results = []
+    for duration in args.durations:
+        results += audio_stages(duration, args.repeat, args.seed)
+    for num_songs in args.songs:
+        for backend in ("dict", "index", "compressed"):
+            if backend == "dict" and num_songs > args.max_dict_songs:
+                continue
+            results += database_stages(num_songs, backend, args.song_seconds, num_queries = args.queries,
+                                       seed = args.seed)
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, mode = "w") as output_file:
+            json.dump(report, output_file, indent = 1)
+    else:
+        json.dump(report, sys.stdout, indent = 1)
+        print()
@@ -0,0 +1,75 @@
+# Deterministic synthetic audio and databases for the benchmarks; everything is generated
+# offline from a seed, so results are comparable between commits and machines.
+
+import numpy as np
+
+
+def tone_mixture(duration, sampling_rate = 44100, seed = 0, num_tones = 6, note_length = 0.25):
+    """
+    A music-like signal: `num_tones` simultaneous sinusoids whose frequencies and amplitudes
+    change every `note_length` seconds
+
+    Parameters
+    ----------
+    duration : float
+        length of the signal in seconds
+    sampling_rate : int
+        samples per second
+    seed : int
+        seed of the random frequencies/amplitudes
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N,), dtype-float32
+        the samples, in [-1, 1]
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration * sampling_rate)
+    note_samples = int(note_length * sampling_rate)
+    num_notes = num_samples // note_samples + 1
+    note = np.arange(num_samples) // note_samples
+
+    samples = np.zeros(num_samples)
+    for _ in range(num_tones):
+        freqs = rng.uniform(80, 5000, num_notes)
+        amps = rng.uniform(0.1, 1.0, num_notes)
+        phase = 2 * np.pi * np.cumsum(freqs[note]) / sampling_rate
+        samples += amps[note] * np.sin(phase)
+    return (samples / num_tones).astype(np.float32)
+
+
+def chirp(duration, sampling_rate = 44100, f0 = 100.0, f1 = 8000.0):
+    """Linear frequency sweep from f0 to f1 Hz over `duration` seconds"""
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
+    phase = 2 * np.pi * (f0 * t + (f1 - f0) * t ** 2 / (2 * duration))
+    return np.sin(phase).astype(np.float32)
+
+
+def noise(duration, sampling_rate = 44100, seed = 0, amplitude = 1.0):
+    """Gaussian white noise"""
+    rng = np.random.default_rng(seed)
+    return (amplitude * rng.standard_normal(int(duration * sampling_rate))).astype(np.float32)
+
+
+def synthetic_song(duration, sampling_rate = 44100, seed = 0):
+    """Tone mixture with a quiet chirp and a little noise; a stand-in for a real recording"""
+    return (tone_mixture(duration, sampling_rate, seed)
+            + 0.2 * chirp(duration, sampling_rate)
+            + noise(duration, sampling_rate, seed + 1, amplitude = 0.05))
+
+
+def synthetic_peaks(seconds, peaks_per_second = 20, num_rows = 2049, frames_per_second = 44100 / 2048, seed = 0):
+    """
+    Random (row, col) peaks in column-major order, as `local_peak_locations` returns them,
+    for building large databases without running the audio stages
+
+    Returns
+    -------
+    numpy.ndarray, shape-(P, 2)
+    """
+    rng = np.random.default_rng(seed)
+    num_peaks = int(seconds * peaks_per_second)
+    cols = rng.integers(0, max(1, int(seconds * frames_per_second)), num_peaks)
+    rows = rng.integers(0, num_rows, num_peaks)
+    order = np.lexsort((rows, cols))
+    return np.stack([rows[order], cols[order]], axis=-1)
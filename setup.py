@@ -6,5 +6,5 @@ PROJECT_NAME = "wahzam"  # change this!
 setuptools.setup(
     name=PROJECT_NAME,
     version="1.0",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks", "benchmarks.*"]),
 )
@@ -1,5 +1,55 @@
-from .databases import *
-from .digital_sampling import *
-from .find_peaks import *
-from .fingerprint import *
-from .main_functions import *
+# The public functions of the submodules are available as wahzam.<name>, but a submodule is
+# only imported the first time one of its names is used (PEP 562), so that e.g. loading a
+# database and matching fingerprints never imports the audio, plotting or JIT stacks.
+
+import importlib
+
+_SUBMODULE_NAMES = {
+    "databases": [
+        "store_fingerprints", "add_artist_info", "add_song", "delete_song", "delete_artist_info",
+        "delete_fingerprint_info", "get_info", "get_id", "load_dictionary", "save_dictionary",
+        "save_index", "load_index", "convert_pickled_database", "most_frequent", "offset_histogram",
+        "merge_offset_histograms", "best_matches", "match_many", "match_scored", "give_matched_songid",
+        "as_hashes", "FingerprintIndex", "INDEX_FORMAT", "INDEX_VERSION", "INDEX_ARRAYS",
+        "CompressedIndex", "COMPRESSED_INDEX_ARRAYS",
+    ],
+    "digital_sampling": [
+        "micsample", "filesample", "fileblocks", "foldersample", "frame_params", "frame_seconds", "resample",
+        "AUDIO_EXTENSIONS",
+    ],
+    "find_peaks": [
+        "get_window", "make_spectogram", "spectrogram_axes", "warm_start", "neighborhood_offsets",
+        "local_peak_locations", "band_edges", "top_peaks_per_column",
+    ],
+    "fingerprint": [
+        "findsfingerprints", "pack_fingerprints", "unpack_fingerprints", "fingerprint_hashes",
+        "target_zone_hashes", "FREQ_BITS", "DT_BITS",
+    ],
+    "main_functions": [
+        "digital_sample", "initialize_database", "query_database", "populate_database",
+        "sample_fingerprints", "file_fingerprints", "cached_file_fingerprints", "query_many",
+        "song_info_from_path", "populate_database_from_folder",
+    ],
+    "streaming": ["StreamingPeakFinder", "StreamingFingerprinter", "StreamingRecognizer", "recognize_stream"],
+    "shards": ["shard_of", "shard_votes", "ShardedIndex"],
+    "wal": ["LoggedDatabase"],
+    "cache": ["FingerprintCache", "file_digest", "array_digest"],
+    "capture": ["RingBuffer", "MicrophoneCapture"],
+    "instrumentation": ["add_hook", "remove_hook", "MetricsRegistry"],
+}
+
+_SUBMODULES = {name: module for module, names in _SUBMODULE_NAMES.items() for name in names}
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        value = getattr(importlib.import_module(f".{_SUBMODULES[name]}", __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,183 @@
+# On-disk cache of the intermediate results of fingerprinting a file. Every entry is keyed
+# by the hash of the file's contents plus the parameters of the stage that produced it and
+# of all the stages before it, so changing e.g. `fanoutsize` only reruns the pairing, while
+# the decoded samples and peaks are reused:
+#
+#   cache = FingerprintCache("~/.cache/wahzam", max_bytes = 2 * 2**30)
+#   samples = cache.get("samples", digest, params)      # None on a miss
+#   cache.put("samples", digest, params, [samples])
+#
+# The cache is bounded by `max_bytes`, evicting the least recently used entries first.
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+# bump to invalidate every entry written by an older version of the pipeline
+CACHE_VERSION = 1
+
+# temporary files older than this are left over from a crashed write
+STALE_TEMP_SECONDS = 3600
+
+# an over-budget cache is evicted down to this fraction of `max_bytes`, so that the next
+# scan is only needed after that much more has been written
+EVICT_TO = 0.9
+
+
+def file_digest(file_path, chunk_size = 2**20):
+    """
+    Returns the hex digest of the contents of a file, so that a renamed or moved file
+    still hits the cache while an edited one does not
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, mode = "rb") as opened_file:
+        for chunk in iter(lambda: opened_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_digest(array):
+    """
+    Returns the hex digest of the contents of an array, for caching the results of
+    in-memory samples that do not come from a file
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((array.dtype.str, array.shape)).encode())
+    digest.update(array.view(np.uint8).ravel())
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    """
+    A size-bounded, least-recently-used cache of arrays on disk
+
+    Parameters
+    ----------
+    directory : string
+        directory of the cache, created if it does not exist
+    max_bytes : int
+        total size of the entries above which the least recently used ones are evicted
+    rescan_every : int
+        number of `put` calls after which the directory is scanned again, to account for
+        the entries written by other processes
+
+    Notes
+    -----
+    Entries are written atomically and the recency of an entry is its file's modification
+    time, so several processes (e.g. the workers of `populate_database_from_folder`) can
+    share one cache directory.
+
+    The total size is tracked as entries are written, so a `put` only scans the directory
+    when the cache is over budget (or every `rescan_every` puts).
+    """
+
+    def __init__(self, directory, max_bytes = 2**30, rescan_every = 256):
+        self.directory = pathlib.Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.rescan_every = rescan_every
+        self._nbytes = None  # estimated total size, None until the directory is scanned
+        self._puts = 0
+
+    def _path(self, stage, digest, params):
+        key = json.dumps([CACHE_VERSION, stage, digest, params], sort_keys=True)
+        return self.directory / f"{stage}-{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.npz"
+
+    def get(self, stage, digest, params):
+        """
+        Returns the arrays stored for (stage, digest, params), or None if there are none
+
+        Parameters
+        ----------
+        stage : str
+            name of the stage, e.g. "samples", "peaks" or "hashes"
+        digest : str
+            `file_digest` of the input file
+        params : dict
+            JSON-serializable parameters of the stage and of every stage before it
+
+        Returns
+        -------
+        Optional[List[numpy.ndarray]]
+            the arrays in the order they were stored
+        """
+        path = self._path(stage, digest, params)
+        try:
+            with np.load(path) as data:
+                arrays = [data[f"arr_{i}"] for i in range(len(data.files))]
+        except (OSError, ValueError):
+            # missing, evicted by another process, or a partial write of a crashed one
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, stage, digest, params, arrays):
+        """Stores the arrays produced by a stage (see `get`), then evicts down to `max_bytes`"""
+        path = self._path(stage, digest, params)
+        try:
+            replaced = path.stat().st_size
+        except OSError:
+            replaced = 0
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as opened_file:
+            np.savez(opened_file, *arrays)
+        size = os.path.getsize(opened_file.name)
+        os.replace(opened_file.name, path)
+
+        self._puts += 1
+        if self._nbytes is None or self._puts % self.rescan_every == 0:
+            self.evict()
+        else:
+            self._nbytes += size - replaced
+            if self._nbytes > self.max_bytes:
+                self.evict(EVICT_TO * self.max_bytes)
+
+    def evict(self, target_bytes = None):
+        """
+        Scans the cache, deleting the temporary files of crashed writes and then the least
+        recently used entries until the cache fits in `target_bytes` (`max_bytes` by default)
+        """
+        if target_bytes is None:
+            target_bytes = self.max_bytes
+        now = time.time()
+        for path in self.directory.glob("*.tmp"):
+            try:
+                if now - path.stat().st_mtime > STALE_TEMP_SECONDS:
+                    path.unlink()
+            except OSError:
+                pass
+
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+        self._nbytes = total
+
+    @property
+    def nbytes(self):
+        return sum(path.stat().st_size for path in self.directory.glob("*.npz"))
+
+    def clear(self):
+        for path in self.directory.glob("*.npz"):
+            path.unlink()
+        self._nbytes = 0
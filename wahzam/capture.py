@@ -0,0 +1,244 @@
+# Always-on audio capture: a background thread writes the int16 frames of the microphone
+# (or of any other source) into a preallocated ring buffer, and consumers read zero-copy
+# views of the most recent audio, so memory stays constant however long it listens:
+#
+#   with MicrophoneCapture(seconds = 20) as capture:
+#       time.sleep(5)
+#       samples = capture.latest(5)        # int16 view of the last 5 seconds
+#
+#   # or feed the audio to a recognizer as it arrives
+#   position = 0
+#   while song_info is None:
+#       samples, position = capture.since(position)
+#       song_info = recognizer.feed(samples.astype(np.float32))
+#
+# `pyaudio` is only imported when the microphone itself is opened.
+
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer holding the last `capacity` samples written to it
+
+    Every sample is written twice, at its position and `capacity` samples after it, so
+    any run of up to `capacity` consecutive samples is contiguous in memory and is read
+    as a view, without copying or reassembling the wrapped-around parts.
+
+    Parameters
+    ----------
+    capacity : int
+        number of samples kept
+    dtype : numpy.dtype
+        type of the samples
+
+    Notes
+    -----
+    One writer and any number of readers can use the buffer from different threads. A
+    view stays valid until `capacity` minus its length more samples have been written,
+    after which the writer overwrites it; copy a view that has to outlive that.
+    """
+
+    def __init__(self, capacity, dtype = np.int16):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.buffer = np.zeros(2 * capacity, dtype=dtype)
+        self.written = 0  # number of samples written since the buffer was created
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of samples held (at most `capacity`)"""
+        return min(self.written, self.capacity)
+
+    def write(self, samples):
+        """Appends samples, overwriting the oldest ones once the buffer is full"""
+        samples = np.asarray(samples, dtype=self.buffer.dtype).ravel()
+        count = len(samples)
+        if count > self.capacity:
+            # only the last `capacity` samples would survive the write
+            samples = samples[-self.capacity:]
+        capacity = self.capacity
+        with self._lock:
+            start = (self.written + count - len(samples)) % capacity
+            end = start + len(samples)
+            if end <= capacity:
+                self.buffer[start:end] = samples
+                self.buffer[start + capacity:end + capacity] = samples
+            else:
+                split = capacity - start
+                self.buffer[start:capacity] = samples[:split]
+                self.buffer[start + capacity:] = samples[:split]
+                self.buffer[:end - capacity] = samples[split:]
+                self.buffer[capacity:end] = samples[split:]
+            self.written += count
+
+    def _view(self, start, end):
+        # view of the samples written between positions start and end (end - start <= capacity)
+        stop = end % self.capacity + self.capacity
+        return self.buffer[stop - (end - start):stop]
+
+    def latest(self, num_samples):
+        """
+        Returns a view of the last `num_samples` samples written (fewer if fewer are held)
+
+        Parameters
+        ----------
+        num_samples : int
+            number of samples, at most `capacity`
+
+        Returns
+        -------
+        numpy.ndarray, shape-(M,)
+            read-only view of the samples, oldest first
+        """
+        if num_samples > self.capacity:
+            raise ValueError(f"Only the last {self.capacity} samples are held")
+        with self._lock:
+            end = self.written
+            view = self._view(max(end - num_samples, 0), end)
+        view.flags.writeable = False
+        return view
+
+    def since(self, position):
+        """
+        Returns a view of the samples written after `position`, for consumers that read
+        the audio as it arrives
+
+        Parameters
+        ----------
+        position : int
+            position (count of samples written) up to which the consumer has read,
+            0 to start from the oldest sample held
+
+        Returns
+        -------
+        (samples, position) : Tuple[numpy.ndarray, int]
+            read-only view of the new samples, and the position to pass to the next call
+
+        Notes
+        -----
+        If the consumer fell more than `capacity` samples behind, the overwritten samples
+        are skipped and the view starts at the oldest sample held.
+        """
+        with self._lock:
+            end = self.written
+            view = self._view(max(position, end - self.capacity, 0), end)
+        view.flags.writeable = False
+        return view, end
+
+
+def _microphone_frames(sampling_rate, frames_per_buffer, stop_event):
+    # int16 mono frames read from the default input device until stop_event is set
+    import pyaudio
+
+    audio = pyaudio.PyAudio()
+    stream = audio.open(format = pyaudio.paInt16, channels = 1, rate = sampling_rate, input = True,
+                        frames_per_buffer = frames_per_buffer)
+    try:
+        while not stop_event.is_set():
+            yield stream.read(frames_per_buffer, exception_on_overflow = False)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        audio.terminate()
+
+
+class MicrophoneCapture:
+    """
+    Records audio on a background thread into a `RingBuffer` holding the last `seconds`
+    seconds
+
+    Parameters
+    ----------
+    seconds : float
+        duration of the audio kept
+    sampling_rate : int
+        sampling rate of the recording
+    source : Optional[Iterable[Union[bytes, numpy.ndarray]]]
+        int16 mono frames to capture (raw bytes or arrays), e.g. from a file or a test;
+        None to record from the default microphone with `pyaudio`
+    frames_per_buffer : int
+        number of samples per microphone read, which bounds the latency of the capture
+
+    Notes
+    -----
+    Use as a context manager, or call `start` and `stop`. Bytes frames are wrapped with
+    np.frombuffer, so the only copy of the audio is the one into the ring buffer. An
+    exception raised by the source stops the capture and is re-raised by `stop`.
+    """
+
+    def __init__(self, seconds = 10, sampling_rate = 44100, source = None, frames_per_buffer = 1024):
+        self.sampling_rate = sampling_rate
+        self.ring = RingBuffer(int(round(seconds * sampling_rate)), dtype=np.int16)
+        self.source = source
+        self.frames_per_buffer = frames_per_buffer
+        self.error = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Starts the capture thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        frames = self.source
+        if frames is None:
+            frames = _microphone_frames(self.sampling_rate, self.frames_per_buffer, self._stop_event)
+        try:
+            for frame in frames:
+                if isinstance(frame, (bytes, bytearray, memoryview)):
+                    frame = np.frombuffer(frame, dtype=np.int16)
+                self.ring.write(frame)
+                if self._stop_event.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            if hasattr(frames, "close"):
+                frames.close()
+
+    def stop(self):
+        """Stops the capture thread, re-raising the exception that stopped it, if any"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def seconds_recorded(self):
+        """Duration of the audio captured since the start, including what was overwritten"""
+        return self.ring.written / self.sampling_rate
+
+    def latest(self, seconds):
+        """
+        Returns a zero-copy int16 view of the last `seconds` seconds of audio (see
+        `RingBuffer.latest`)
+        """
+        return self.ring.latest(int(round(seconds * self.sampling_rate)))
+
+    def since(self, position):
+        """
+        Returns (int16 view of the audio captured after `position`, new position) (see
+        `RingBuffer.since`)
+        """
+        return self.ring.since(position)
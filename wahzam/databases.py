@@ -1,6 +1,17 @@
 # storing song information and fingerprints in python dictionaries
+import json
+import os
+import pathlib
 import pickle
+import time
 from collections import Counter
+
+import numpy as np
+
+from .digital_sampling import frame_seconds
+from .fingerprint import pack_fingerprints
+from . import instrumentation
+from .instrumentation import instrumented
 # Functions to be implemented:
 #   - Compare UNKNOWN fingerprint to fingerprint database to get MATCHES
 
@@ -26,8 +37,12 @@ def store_fingerprints(abs_times, fingerprints, fingerprint_database, song_id):
 
     Notes
     -----
-    
+    fingerprint_database may also be a `FingerprintIndex` (or `ShardedIndex`), in which
+    case the fingerprints can be given as tuples or as packed hashes
     """
+    if not isinstance(fingerprint_database, dict):
+        fingerprint_database.add(fingerprints, abs_times, song_id)
+        return
 
     for i in range (len(fingerprints)):
         if fingerprint_database.__contains__(fingerprints[i]):
@@ -37,7 +52,7 @@ def store_fingerprints(abs_times, fingerprints, fingerprint_database, song_id):
             fingerprint_database[fingerprints[i]] = [(song_id, abs_times[i])] 
 
 # Mindy's Datbase
-def add_artist_info(song, artist, artist_database): # input song name, artist title
+def add_artist_info(song, artist, artist_database, first_number = 0): # input song name, artist title
     """Creating a unique string id, corresponds this id to the song name and artist name,
     adds this information to the song_info database, and returns the song id
     
@@ -53,6 +68,10 @@ def add_artist_info(song, artist, artist_database): # input song name, artist ti
         A dictionary of the unique song id's corresponding to its song name and
         artist name
 
+    first_number : int
+        lowest number the id may use, e.g. the number of songs ever added to the
+        fingerprint database
+
     Returns
     -------
     song_id : string
@@ -62,8 +81,17 @@ def add_artist_info(song, artist, artist_database): # input song name, artist ti
     -----
     The returned song_id should be used as the song id when the fingerprint tuples
     are being saved in the store_fingerprints method
+
+    `add_song` passes the length of the song table of an array-backed database as
+    `first_number`. That table keeps a slot for every song ever added, deleted ones
+    included, and is saved in the header, so it is a persistent counter and the id of a
+    deleted song is never handed out again. A dict database has no such counter.
     """
-    song_id = "Song" + str(len(artist_database))
+    number = max(len(artist_database), first_number)
+    # after deletions len(artist_database) may already be taken
+    while "Song" + str(number) in artist_database:
+        number += 1
+    song_id = "Song" + str(number)
     artist_database[song_id] = (song, artist)
     return song_id
     
@@ -97,7 +125,9 @@ def add_song(fingerprints, abs_times, name, artist, artist_database, fingerprint
     -----
     
     """
-    song_id = add_artist_info(name, artist, artist_database)
+    # the song table of an array-backed database counts every song ever added (see `add_artist_info`)
+    first_number = 0 if isinstance(fingerprint_database, dict) else len(fingerprint_database.song_ids)
+    song_id = add_artist_info(name, artist, artist_database, first_number)
     store_fingerprints(abs_times, fingerprints, fingerprint_database, song_id)
 
 def delete_song(name, artist, artist_database, fingerprint_database):
@@ -123,14 +153,14 @@ def delete_song(name, artist, artist_database, fingerprint_database):
     
     Notes
     -----
-    
+    Raises a KeyError if the song is not in the artist_database
     """
-    key_list = artist_database.keys()
-    value_list = artist_database.values()
-
-    index = value_list.index((name, artist))
     # find the song_id of the deleted song based on name and artist input
-    song_id = key_list[index]
+    for song_id, info in artist_database.items():
+        if info == (name, artist):
+            break
+    else:
+        raise KeyError((name, artist))
 
     # delete the song info from artist_database
     delete_artist_info(song_id, name, artist, artist_database)
@@ -158,25 +188,9 @@ def delete_artist_info(song_id, name, artist, artist_database):
     
     Notes
     -----
-    Because we use the length of the artist_database to create new song_ids,
-    we must iterate through each value and replace the preceeding song info
-    with the new song info to maintain the song_id order. Then, simply delete
-    the last value of the dictionary.
-    """
-    # create list of keys from artist_database
-    key_list = list(artist_database.keys())
-
-    # iterate through indices of the key_list
-    for i in range(len(key_list)):
-        # check if the key at this index is equal to the song_id
-        if str(key_list[i]) == song_id:
-            # iterate through the last part of the for loop and begin replacing values with the values proceeding it
-            for i in range(i, len(key_list) - 1):
-                artist_database[key_list[i]] = artist_database[key_list[i + 1]]
-        
-            # delete the last element of the dictionary and break the loop
-            artist_database.pop(key_list[len(key_list) - 1])
-            break
+    Song ids are stable: the other songs keep their ids (see `add_artist_info`).
+    """
+    artist_database.pop(song_id)
 
 def delete_fingerprint_info(song_id, fingerprint_database):
     """
@@ -186,7 +200,7 @@ def delete_fingerprint_info(song_id, fingerprint_database):
     ----------
     song_id: string
         song_id of song that needs to be deleted   
-    fingerprint_database: dictionary
+    fingerprint_database: Union[dictionary, FingerprintIndex]
         database of the fingerprints
     
     Returns
@@ -195,44 +209,23 @@ def delete_fingerprint_info(song_id, fingerprint_database):
     
     Notes
     -----
-    As we edited the song_ids in the artist_database, this change in the song_ids 
-    must be reflected in the fingerprint_database as well. If the song we want 
-    deleted is located in the list of tuples following each fingerprint, it must
-    be removed from the list, and if a fingerprint is only from that song, the 
-    entire fingerprint can be removed.
+    For a `FingerprintIndex` the song is tombstoned (see `FingerprintIndex.delete`), which
+    only costs the song's own postings. A dict database has no reverse index, so every
+    fingerprint is visited: the song is removed from the list of tuples following each
+    fingerprint, and if a fingerprint is only from that song, the entire fingerprint is removed.
     """
-    
-    # fingerprint_database = {<fingerprint>:[(songID1, time1),  (songID2, time2)...]}
-    
-    # iterate through every item in fingerprint_database
-    key_list = list(fingerprint_database.keys())
-    value_list = list(fingerprint_database.values())
-    key_len = len(key_list)
-    j = 0
-
-    while j < key_len:
-        i = 0
-        value_len = len(value_list[j])
-        # iterate through every tuple in the list of songs corresponding to each fingerprint
-        while i < value_len:
-            # if the song_id matches one of the song IDs of the tuples, remove it from the list
-            if value_list[j][i][0] == song_id:
-                del fingerprint_database[key_list[j]][i]
-                value_len -= 1
-            # if the number of the song_id is greater than the deleted song's song_id, subtract 1 from its value
-            elif str(value_list[j][i][0]).split(" ")[1] > song_id.split(" ")[1]:
-                song = ("Song " + str(int(str(value_list[j][i][0]).split(" ")[1]) - 1), value_list[j][i][1])
-                del fingerprint_database[key_list[j]][i]
-                fingerprint_database[key_list[j]].insert(i, song)
-                i += 1
-            else:
-                i += 1
-        
-        # if the length of the list is 0, that means the list is empty and the fingerprint is unneeded
-        if value_len == 0:
-            del fingerprint_database[key_list[j]]
+    if not isinstance(fingerprint_database, dict):
+        fingerprint_database.delete(song_id)
+        return
 
-        j += 1
+    # fingerprint_database = {<fingerprint>:[(songID1, time1),  (songID2, time2)...]}
+    for fingerprint in list(fingerprint_database.keys()):
+        postings = [posting for posting in fingerprint_database[fingerprint] if posting[0] != song_id]
+        # if the list is empty, the fingerprint is unneeded
+        if postings:
+            fingerprint_database[fingerprint] = postings
+        else:
+            del fingerprint_database[fingerprint]
 
 
 def get_info(song_id, artist_database):
@@ -276,6 +269,8 @@ def get_id(fingerprint, fingerprint_database):
     -----
     returns None if has no corresponding entry
     """
+    if not isinstance(fingerprint_database, dict):
+        return fingerprint_database.lookup(fingerprint)
     if not fingerprint_database.__contains__(fingerprint):
         return None
     return fingerprint_database[fingerprint]
@@ -321,11 +316,459 @@ def save_dictionary(dict, file_path):
     with open(file_path, mode = "wb") as opened_file:
         pickle.dump(dict, opened_file)
 
+
+# On-disk index format: a directory holding one raw little-endian file per CSR array
+# plus a JSON header with the array dtypes/shapes, the song id table and the artist_database
+INDEX_FORMAT = "wahzam-index"
+INDEX_VERSION = 1
+INDEX_ARRAYS = {"keys": "<u8", "offsets": "<i8", "song_indices": "<i4", "times": "<i4", "stopped_keys": "<u8"}
+# arrays of a `CompressedIndex`, saved in the same layout with "compressed" as the header's "index"
+COMPRESSED_INDEX_ARRAYS = {"block_keys": "<u8", "block_bytes": "<i8", "block_postings": "<i8", "data": "|u1",
+                           "stopped_keys": "<u8"}
+
+
+def save_index(fingerprint_index, artist_database, directory, metadata = None):
+    """
+    saves a FingerprintIndex and its artist_database to a directory that `load_index`
+    can memory-map
+    Parameters
+    ----------
+    fingerprint_index: Union[FingerprintIndex, CompressedIndex]
+        index to save
+    artist_database: dictionary
+        database that maps songid to artist name and song name
+    directory: string
+        path of the directory to store the database to, created if needed
+    metadata: Optional[dictionary]
+        JSON-serializable information stored in the header along with the index, e.g. the
+        position in a write-ahead log (see `wal.LoggedDatabase`)
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    The header is written last (through a temporary file), so a crash mid-save never
+    leaves a header that describes arrays which were not fully written.
+
+    Layout of the directory:
+        header.json          format, version, index params (including the analysis sampling rate),
+                             dtype/shape/file of each array, song ids (None for deleted songs),
+                             deleted songs not compacted yet, artist_database
+        keys.<gen>.bin       uint64 sorted unique hash keys
+        offsets.<gen>.bin    int64 CSR offsets into the posting arrays
+        song_indices.<gen>.bin, times.<gen>.bin   int32 postings
+        stopped_keys.<gen>.bin   uint64 sorted stop-listed hash keys
+    or, for a CompressedIndex, its block arrays (see `COMPRESSED_INDEX_ARRAYS`).
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    fingerprint_index.flush()
+    if isinstance(fingerprint_index, FingerprintIndex):
+        # the stop list is applied when the index is built (saved) or compacted
+        fingerprint_index._limit_postings()
+
+    # every save writes a new generation of array files, so processes that have the
+    # previous generation memory-mapped keep reading valid data
+    old_files = []
+    generation = 0
+    if (directory / "header.json").exists():
+        with open(directory / "header.json") as opened_file:
+            old_header = json.load(opened_file)
+        generation = old_header.get("generation", 0) + 1
+        old_files = [spec["file"] for spec in old_header.get("arrays", {}).values()]
+
+    if isinstance(fingerprint_index, CompressedIndex):
+        kind, array_dtypes = "compressed", COMPRESSED_INDEX_ARRAYS
+        params = {"block_size": fingerprint_index.block_size, "num_keys": fingerprint_index.num_keys}
+    else:
+        kind, array_dtypes = "postings", INDEX_ARRAYS
+        params = {"max_postings": fingerprint_index.max_postings, "cap_postings": fingerprint_index.cap_postings}
+    params["sampling_rate"] = fingerprint_index.sampling_rate
+    params["stopped_postings"] = fingerprint_index.stopped_postings
+    params.update(_index_settings(fingerprint_index))
+
+    arrays = {}
+    for name, dtype in array_dtypes.items():
+        array = np.ascontiguousarray(getattr(fingerprint_index, name), dtype=dtype)
+        file_name = f"{name}.{generation}.bin"
+        array.tofile(directory / file_name)
+        arrays[name] = {"file": file_name, "dtype": dtype, "shape": list(array.shape)}
+
+    header = {
+        "format": INDEX_FORMAT,
+        "version": INDEX_VERSION,
+        "generation": generation,
+        "index": kind,
+        "params": params,
+        "arrays": arrays,
+        "song_ids": fingerprint_index.song_ids,
+        # deleted songs whose postings `compact` has not removed yet
+        "uncompacted": sorted(getattr(fingerprint_index, "_uncompacted", ())),
+        "artist_database": [[song_id, list(info)] for song_id, info in artist_database.items()],
+        "metadata": metadata or {},
+    }
+    temp_path = directory / "header.json.tmp"
+    with open(temp_path, mode = "w") as opened_file:
+        json.dump(header, opened_file)
+    os.replace(temp_path, directory / "header.json")
+
+    for file_name in old_files:
+        (directory / file_name).unlink(missing_ok=True)
+
+
+def load_index(directory, mmap_mode = "r"):
+    """
+    opens a database saved by `save_index`
+    Parameters
+    ----------
+    directory: string
+        path of the database directory
+    mmap_mode: Optional[string]
+        mode passed to np.memmap ("r" shares the page-cached files between all processes
+        that open them without copying), or None to read the arrays into memory
+    Returns
+    -------
+    Tuple[Union[FingerprintIndex, CompressedIndex], dictionary]
+        the fingerprint index and the artist_database
+
+    Notes
+    -----
+    Adding songs to a memory-mapped index is allowed: the next merge copies the arrays
+    into memory, leaving the files untouched. Databases saved before the sampling rate
+    was recorded are 44100 Hz ones.
+    """
+    directory = pathlib.Path(directory)
+    with open(directory / "header.json") as opened_file:
+        header = json.load(opened_file)
+    if header.get("format") != INDEX_FORMAT:
+        raise ValueError(f"{directory} is not a {INDEX_FORMAT} database")
+    if header.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported {INDEX_FORMAT} version {header.get('version')} (expected {INDEX_VERSION})")
+
+    params = dict(header.get("params", {}))
+    stopped_postings = params.pop("stopped_postings", 0)
+    if header.get("index") == "compressed":
+        num_keys = params.pop("num_keys")
+        fingerprint_index = CompressedIndex(**params)
+        fingerprint_index.num_keys = num_keys
+    else:
+        fingerprint_index = FingerprintIndex(**params)
+    fingerprint_index.stopped_postings = stopped_postings
+    for name, spec in header["arrays"].items():
+        path = directory / spec["file"]
+        shape = tuple(spec["shape"])
+        if mmap_mode is None or np.prod(shape) == 0:
+            # np.memmap cannot map an empty file
+            array = np.fromfile(path, dtype=spec["dtype"]).reshape(shape)
+        else:
+            array = np.memmap(path, dtype=spec["dtype"], mode=mmap_mode, shape=shape)
+        setattr(fingerprint_index, name, array)
+    fingerprint_index._set_song_ids(header["song_ids"], header.get("uncompacted"))
+
+    artist_database = {song_id: tuple(info) for song_id, info in header["artist_database"]}
+    return fingerprint_index, artist_database
+
+
+def convert_pickled_database(fingerprint_path, artist_path, directory):
+    """
+    converts a pickled fingerprint_database/artist_database pair (see `save_dictionary`)
+    into the on-disk index format
+    Parameters
+    ----------
+    fingerprint_path: string
+        path of the pickled fingerprint_database
+    artist_path: string
+        path of the pickled artist_database
+    directory: string
+        path of the directory to store the converted database to
+    Returns
+    -------
+    Tuple[FingerprintIndex, dictionary]
+        the converted fingerprint index and the artist_database
+    """
+    fingerprint_index = FingerprintIndex.from_dict(load_dictionary(fingerprint_path))
+    artist_database = load_dictionary(artist_path)
+    save_index(fingerprint_index, artist_database, directory)
+    return fingerprint_index, artist_database
+
 def most_frequent(somelist):
     #this is needed to count which tuple most common in the give_matched_songid(), need the Counter import
     occurences_count = Counter(somelist)
     return occurences_count.most_common(1)[0][0]
     
+@instrumented("vote", lambda bins: {"bins": len(bins[0]), "candidates": len(np.unique(bins[0]))})
+def offset_histogram(song_indices, offsets):
+    """
+    Counts the votes of every (song, offset) bin
+
+    Parameters
+    ----------
+    song_indices: numpy.ndarray[int]
+        song index of each matched posting
+    offsets: numpy.ndarray[int]
+        database time minus clip time of each matched posting
+
+    Returns
+    -------
+    bin_songs, bin_offsets, bin_counts: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        the song index, offset and number of votes of every non-empty bin
+
+    Notes
+    -----
+    Each (song, offset) pair is encoded into one int64 key, so the counting is a single
+    `np.bincount` when the bins are dense and a single `np.unique` otherwise.
+    """
+    song_indices = np.asarray(song_indices, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(song_indices) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    min_offset = offsets.min()
+    span = offsets.max() - min_offset + 1
+    encoded = song_indices * span + (offsets - min_offset)
+    num_bins = (song_indices.max() + 1) * span
+    if num_bins <= 4 * len(encoded) + 1024:
+        counts = np.bincount(encoded, minlength=num_bins)
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        keys, counts = np.unique(encoded, return_counts=True)
+    return keys // span, keys % span + min_offset, counts
+
+
+def merge_offset_histograms(histograms):
+    """
+    Adds up offset histograms (see `offset_histogram`), e.g. partial votes from several
+    shards or from several chunks of a clip
+
+    Parameters
+    ----------
+    histograms: Iterable[Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]]
+        (bin_songs, bin_offsets, bin_counts) of each histogram
+
+    Returns
+    -------
+    bin_songs, bin_offsets, bin_counts: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        the song index, offset and total number of votes of every non-empty bin
+    """
+    histograms = list(histograms)
+    if not histograms:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    songs = np.concatenate([h[0] for h in histograms]).astype(np.int64)
+    offsets = np.concatenate([h[1] for h in histograms]).astype(np.int64)
+    counts = np.concatenate([h[2] for h in histograms]).astype(np.int64)
+    if len(songs) == 0:
+        return songs, offsets, counts
+    bins, inverse = np.unique(np.stack([songs, offsets]), axis=1, return_inverse=True)
+    return bins[0], bins[1], np.bincount(inverse.ravel(), weights=counts, minlength=bins.shape[1]).astype(np.int64)
+
+
+def best_matches(bin_songs, bin_offsets, bin_counts, top_k = 1):
+    """
+    Picks the best songs from an offset histogram (see `offset_histogram`)
+
+    Parameters
+    ----------
+    bin_songs, bin_offsets, bin_counts: numpy.ndarray
+        song index, offset and number of votes of each bin
+    top_k: Optional[int]
+        how many songs to return, None for all of them
+
+    Returns
+    -------
+    songs, votes, offsets: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+        the top_k songs ordered by decreasing votes, each with the votes and offset of
+        its best bin
+    """
+    # order bins by decreasing votes, then keep the first (best) bin of every song
+    order = np.argsort(-bin_counts, kind="stable")
+    _, first = np.unique(bin_songs[order], return_index=True)
+    best = order[np.sort(first)][:top_k]
+    return bin_songs[best], bin_counts[best], bin_offsets[best]
+
+
+def _background_scores(votes, background):
+    # Poisson z-score of the votes of songs against the background votes (see `match_scored`)
+    return (votes - background) / np.sqrt(np.maximum(votes + background, 1))
+
+
+def match_many(fingerprint_database, hash_lists, time_lists, top_k = 1, min_score = 2.0):
+    """
+    Matches many clips with a single index lookup
+
+    Parameters
+    ----------
+    fingerprint_database: Union[FingerprintIndex, ShardedIndex]
+        database of the fingerprints
+    hash_lists: List[numpy.ndarray]
+        packed fingerprint hashes of each clip
+    time_lists: List[numpy.ndarray]
+        anchor time of each fingerprint of each clip
+    top_k: int
+        how many songs to return per clip
+    min_score: Optional[float]
+        songs scoring below this against the song ranked right after them (as in
+        `match_scored`) are not returned, so a clip that matches nothing gets an empty
+        list; None to return the top_k songs whatever their votes
+
+    Returns
+    -------
+    List[List[Tuple[Hashable, int, int]]]
+        for each clip, the (song id, votes, offset) of its top_k songs (see `FingerprintIndex.match`)
+
+    Notes
+    -----
+    The hashes of all clips are concatenated, looked up with one `lookup_many` call and
+    voted on with one offset histogram whose "songs" are (clip, song) pairs.
+    """
+    num_clips = len(hash_lists)
+    if num_clips == 0:
+        return []
+    hashes = np.concatenate([np.asarray(h, dtype=np.uint64) for h in hash_lists])
+    abs_times = np.concatenate([np.asarray(t, dtype=np.int64) for t in time_lists])
+    clips = np.repeat(np.arange(num_clips), [len(h) for h in hash_lists])
+
+    query_positions, song_indices, times = fingerprint_database.lookup_many(hashes)
+    num_songs = len(fingerprint_database.song_ids)
+    clip_songs = clips[query_positions] * num_songs + song_indices
+    clip_songs, votes, offsets = best_matches(*offset_histogram(clip_songs, times - abs_times[query_positions]),
+                                              top_k=None)
+
+    # best_matches orders by decreasing votes; a stable sort by clip keeps that order within each clip
+    clip_of_match = clip_songs // num_songs
+    order = np.argsort(clip_of_match, kind="stable")
+    clip_of_match = clip_of_match[order]
+    rank = np.arange(len(order)) - np.searchsorted(clip_of_match, clip_of_match)
+    keep = rank < top_k
+    if min_score is not None:
+        # the background of a song is the votes of the next song of the same clip
+        ranked_votes = votes[order]
+        background = np.append(ranked_votes[1:], 0)
+        background[np.append(clip_of_match[1:] != clip_of_match[:-1], True)] = 0
+        keep &= _background_scores(ranked_votes, background) >= min_score
+    order = order[keep]
+
+    results = [[] for _ in range(num_clips)]
+    song_ids = fingerprint_database.song_ids
+    for clip_song, vote, offset in zip(clip_songs[order].tolist(), votes[order].tolist(), offsets[order].tolist()):
+        results[clip_song // num_songs].append((song_ids[clip_song % num_songs], vote, offset))
+    return results
+
+
+def match_scored(fingerprint_database, fingerprints, abs_times, top_k = 1, chunk_size = 1024, stop_score = 5.0,
+                 min_score = 2.0, seconds_per_frame = None):
+    """
+    Matches a clip chunk by chunk, stopping as soon as the best match is clear, and scores
+    the matches so that a clip that matches nothing can be told apart
+
+    Parameters
+    ----------
+    fingerprint_database: Union[FingerprintIndex, ShardedIndex]
+        database of the fingerprints
+    fingerprints: Union[List[Tuple[int, int, int]], numpy.ndarray]
+        fingerprint tuples or packed hashes of the clip, in clip order
+    abs_times: array_like[int]
+        the time in the clip of each fingerprint
+    top_k: int
+        how many songs to return
+    chunk_size: int
+        number of query fingerprints looked up and voted on between two checks of the scores
+    stop_score: float
+        score of the leading song (against the runner-up) above which the remaining
+        fingerprints are not looked up
+    min_score: float
+        songs scoring below this are not returned, so a clip that matches nothing
+        returns an empty list
+    seconds_per_frame: Optional[float]
+        duration of one spectrogram column, to convert the offsets to seconds; defaults to
+        the column duration at the database's sampling rate
+
+    Returns
+    -------
+    List[Tuple[Hashable, float, float]]
+        (song id, score, offset in seconds) of at most top_k songs, ordered by decreasing score
+
+    Notes
+    -----
+    The votes of a song's best (song, offset) bin are compared to those of the best bin of
+    the song ranked right after it, which estimates the votes a song gets by chance (for
+    the leader, the runner-up's). Treating both counts as Poisson, the score of a song with
+    v votes against b background votes is the z-score of their difference,
+    (v - b) / sqrt(v + b). The scores, and so the early stop, do not depend on top_k.
+    """
+    hashes = as_hashes(fingerprints)
+    abs_times = np.asarray(abs_times, dtype=np.int64)
+    if len(hashes) == 0:
+        return []
+    empty = np.empty(0, dtype=np.int64)
+    histogram = (empty, empty, empty)
+    for start in range(0, len(hashes), chunk_size):
+        query_positions, song_indices, times = fingerprint_database.lookup_many(hashes[start:start + chunk_size])
+        offsets = times - abs_times[start:start + chunk_size][query_positions]
+        histogram = merge_offset_histograms([histogram, offset_histogram(song_indices, offsets)])
+
+        songs, votes, offsets = best_matches(*histogram, top_k=top_k + 1)
+        # every song is scored against the song ranked right after it, so the leader is
+        # always scored against the runner-up, whatever top_k
+        background = np.append(votes[1:], 0)[:top_k]
+        scores = _background_scores(votes[:top_k], background)
+        if len(scores) and scores[0] >= stop_score:
+            break
+
+    if seconds_per_frame is None:
+        seconds_per_frame = frame_seconds(getattr(fingerprint_database, "sampling_rate", 44100))
+    keep = scores >= min_score
+    song_ids = fingerprint_database.song_ids
+    return [(song_ids[s], sc, o * seconds_per_frame)
+            for s, sc, o in zip(songs[:top_k][keep].tolist(), scores[keep].tolist(), offsets[:top_k][keep].tolist())]
+
+
+def _analysis_rate(fingerprint_database, sampling_rate):
+    # the sampling rate to fingerprint at for `fingerprint_database`: its own if it records
+    # one (dict databases do not), which `sampling_rate` must then agree with
+    database_rate = getattr(fingerprint_database, "sampling_rate", None)
+    if sampling_rate is None:
+        return database_rate or 44100
+    if database_rate is not None and sampling_rate != database_rate:
+        raise ValueError(f"The database was fingerprinted at {database_rate} Hz, not {sampling_rate} Hz")
+    return sampling_rate
+
+
+# the peak picking and pairing options an index records, so that clips are fingerprinted
+# the same way as the songs it was built from (see `sample_fingerprints`)
+FINGERPRINT_SETTINGS = ("peaks_per_column", "bands", "target_zone")
+
+
+def _setting_value(value):
+    # hashable, JSON-compatible form of a fingerprint setting: None, an int or a tuple of ints
+    if value is None:
+        return None
+    if np.ndim(value) == 0:
+        return int(value)
+    return tuple(int(item) for item in value)
+
+
+def _index_settings(fingerprint_index):
+    # {name: value} of the FINGERPRINT_SETTINGS recorded by fingerprint_index
+    return {name: getattr(fingerprint_index, name, None) for name in FINGERPRINT_SETTINGS}
+
+
+def _fingerprint_settings(fingerprint_database, **settings):
+    # the FINGERPRINT_SETTINGS to fingerprint with for `fingerprint_database`: the given
+    # ones for a dict database, else those the index records, which the given ones (None
+    # or omitted to use the index's) must then agree with
+    if isinstance(fingerprint_database, dict):
+        return {name: _setting_value(settings.get(name)) for name in FINGERPRINT_SETTINGS}
+    resolved = {}
+    for name in FINGERPRINT_SETTINGS:
+        value, database_value = _setting_value(settings.get(name)), getattr(fingerprint_database, name, None)
+        if value is not None and value != database_value:
+            raise ValueError(f"The database was fingerprinted with {name} = {database_value}, not {value}")
+        resolved[name] = database_value
+    return resolved
+
+
 def give_matched_songid(fingerprintslist, fingerprint_database, timeslist):
     """
         Takes in list of fingerprints, the database for them, and the list of times corresponding to the beginning of each fingerprint
@@ -334,38 +777,701 @@ def give_matched_songid(fingerprintslist, fingerprint_database, timeslist):
         Parameters
         ----------
         fingerprintslist : list
-            The list of data containing all fingerprints.
+            The list of data containing all fingerprints (or packed hashes when fingerprint_database is a `FingerprintIndex`).
         timeslist : list
             The list of data corresponding to the initial times at which each fingerprint in the fingerprintslist is taken.
         Returns
         -------
         finalsongid : string
-              returns first term in tuple of (songID, time) of the most frequent occurance
+              returns first term in tuple of (songID, time) of the most frequent occurance, None if nothing matched
+              (for a `FingerprintIndex`, also None when the best song does not clear the score threshold of `match_scored`)
         """
-    final_list = []
-    dictionarylist = []
+    if not isinstance(fingerprint_database, dict):
+        matches = match_scored(fingerprint_database, fingerprintslist, timeslist)
+        return matches[0][0] if matches else None
+
+    song_ids = []
+    offsets = []
     for i in range(len(fingerprintslist)):
 
         # check if fingerprint is in dictionary
         if fingerprintslist[i] in fingerprint_database:
 
             # if so, use the fingerprint as key to pull from dictionary the songids/times(in dictionary)
-            dictionarylist = fingerprint_database[fingerprintslist[i]]
-            # generate new list of tuples by keeping the song id, and subtracting the times(in dictionary) and the initial times (from clip fingerprint)
-            #dictionary = [list(ele) for ele in dictionarylist]
-            for j in range(0,len(dictionarylist),3):
-                temptuple = (dictionarylist[j][0], dictionarylist[j][1] - timeslist[i])
-                final_list.append(temptuple)
-    # print(len(dictionarylist))
-
-    # final_list = [(j[0],j[1]-timeslist[i]) for j in dictionarylist]
+            # and keep the song id and the times(in dictionary) minus the initial time (from clip fingerprint)
+            for song_id, time in fingerprint_database[fingerprintslist[i]]:
+                song_ids.append(song_id)
+                offsets.append(time - timeslist[i])
+    if not song_ids:
+        return None
+
     # find which (song_id, offset time) occurs the most
-    finaltuple = most_frequent(final_list)
-    finalsongid = finaltuple[0]
-    # print(final_list)
+    unique_ids, song_indices = np.unique(np.array(song_ids, dtype=object), return_inverse=True)
+    songs, _, _ = best_matches(*offset_histogram(song_indices, offsets))
+    finalsongid = unique_ids[songs[0]]
 
     return finalsongid
 
+def as_hashes(fingerprints):
+    """
+    Converts fingerprints to packed hash keys
+
+    Parameters
+    ----------
+    fingerprints: Union[List[Tuple[int, int, int]], numpy.ndarray]
+        fingerprint tuples, a shape-(N, 3) array of them, or already-packed hashes
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N,), dtype-uint64
+        the packed hash key of each fingerprint
+    """
+    fingerprints = np.asarray(fingerprints)
+    if fingerprints.size == 0:
+        return np.empty(0, dtype=np.uint64)
+    if fingerprints.ndim == 2:
+        return pack_fingerprints(fingerprints[:, 0], fingerprints[:, 1], fingerprints[:, 2])
+    return fingerprints.astype(np.uint64, copy=False)
+
+
+class FingerprintIndex:
+    """
+    Array-backed inverted index from fingerprint hash to (song, time) postings.
+
+    The postings are stored in CSR form: `keys` holds the sorted unique hash keys, and the
+    postings of `keys[k]` are `song_indices[offsets[k]:offsets[k + 1]]` and
+    `times[offsets[k]:offsets[k + 1]]`. Songs are stored as int32 indices into `song_ids`,
+    which holds the song id used by the artist_database.
+
+    Postings added with `add`/`add_many` are buffered and merged into the CSR arrays in
+    one sort the next time the index is read (or when `flush` is called), so adding many
+    songs in a row costs a single merge.
+
+    Song indices are stable: deleting a song (`delete`) only tombstones its index, whose
+    postings are filtered out of every lookup until `compact` removes them. Indices of
+    deleted songs are never reused. A reverse index from each song to its hash keys lets
+    `compact` touch only the keys of the deleted songs.
+
+    Keys with more than `max_postings` postings (e.g. hashes of silence or of a tone that
+    many songs share) cost the most to look up and discriminate the least. When
+    `max_postings` is set they are moved to the `stopped_keys` stop list when the index
+    is compacted or saved (not at every merge, which would rescan all the keys), and
+    their postings are dropped (or, with `cap_postings`, only their first `max_postings`
+    postings are kept); `stopped_postings` counts the postings removed. New postings of
+    stop-listed keys are dropped as they are merged. Query hashes on the stop list are
+    skipped, and counted in `skipped_lookups` and as "skipped" in the "lookup"
+    instrumentation.
+
+    Parameters
+    ----------
+    max_postings: Optional[int]
+        posting count above which a key is stop-listed (or capped), None for no limit
+    cap_postings: bool
+        whether to keep the first `max_postings` postings of frequent keys instead of
+        stop-listing them
+    sampling_rate: int
+        analysis sampling rate of the fingerprints (see `digital_sampling.frame_params`);
+        clips must be fingerprinted at the same rate to match
+    peaks_per_column: Optional[int]
+    bands: Optional[Union[int, Sequence[int]]]
+        peak budget the fingerprints were picked with (see `find_peaks.local_peak_locations`);
+        clips are fingerprinted with the same budget to match
+    target_zone: Optional[Tuple[int, int, int]]
+        (t_min, t_max, f_max) the peaks were paired within (see `fingerprint.target_zone_hashes`),
+        None if they were paired with the next peaks; clips are paired the same way to match
+
+    Notes
+    -----
+    Can be passed anywhere a dict fingerprint_database is accepted (`store_fingerprints`,
+    `add_song`, `get_id`, `give_matched_songid`).
+    """
+
+    def __init__(self, max_postings = None, cap_postings = False, sampling_rate = 44100, peaks_per_column = None,
+                 bands = None, target_zone = None):
+        self.max_postings = max_postings
+        self.cap_postings = cap_postings
+        self.sampling_rate = sampling_rate
+        self.peaks_per_column = _setting_value(peaks_per_column)
+        self.bands = _setting_value(bands)
+        self.target_zone = _setting_value(target_zone)
+        self.stopped_keys = np.empty(0, dtype=np.uint64)
+        self.stopped_postings = 0  # postings removed by the stop list (or the caps)
+        self.skipped_lookups = 0  # query hashes skipped because they are stop-listed
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.song_indices = np.empty(0, dtype=np.int32)
+        self.times = np.empty(0, dtype=np.int32)
+        self.song_ids = []
+        self.tombstones = np.zeros(0, dtype=bool)
+        self._song_lookup = {}
+        self._song_keys = {}
+        self._uncompacted = set()
+        self._pending = []
+
+    @classmethod
+    def from_dict(cls, fingerprint_database):
+        """
+        Builds an index from a dict fingerprint_database
+        {<fingerprint>:[(songID, time), (songID, time)...]}
+        """
+        index = cls()
+        keys, song_ids, times = [], [], []
+        for fingerprint, postings in fingerprint_database.items():
+            for song_id, time in postings:
+                keys.append(fingerprint)
+                song_ids.append(index.song_index(song_id))
+                times.append(time)
+        index.add_many(as_hashes(keys), times, song_ids)
+        index.flush()
+        return index
+
+    def __len__(self):
+        self.flush()
+        return len(self.song_indices)
+
+    def __contains__(self, fingerprint):
+        self.flush()
+        key = as_hashes([fingerprint])
+        pos = np.searchsorted(self.keys, key)
+        return bool(pos[0] < len(self.keys) and self.keys[pos[0]] == key[0])
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the index arrays"""
+        self.flush()
+        return self.keys.nbytes + self.offsets.nbytes + self.song_indices.nbytes + self.times.nbytes
+
+    def song_index(self, song_id):
+        """Returns the int index of `song_id`, registering the song if it is new"""
+        index = self._song_lookup.get(song_id)
+        if index is None:
+            index = len(self.song_ids)
+            self.song_ids.append(song_id)
+            self._song_lookup[song_id] = index
+            if index >= len(self.tombstones):
+                # grown geometrically, so registering n songs one by one costs O(n)
+                self.tombstones = np.concatenate([self.tombstones, np.zeros(max(index, 16), dtype=bool)])
+        return index
+
+    def _set_song_ids(self, song_ids, uncompacted = None):
+        # restores the song table of a saved index; deleted songs are saved as None, and
+        # `uncompacted` lists those whose postings are still there (None if unknown, then
+        # all of them are assumed to be)
+        self.song_ids = list(song_ids)
+        self.tombstones = np.array([song_id is None for song_id in self.song_ids], dtype=bool)
+        self._song_lookup = {song_id: i for i, song_id in enumerate(self.song_ids) if song_id is not None}
+        if uncompacted is None:
+            uncompacted = np.flatnonzero(self.tombstones).tolist()
+        self._uncompacted = set(uncompacted)
+
+    def song_keys(self, song_index):
+        """
+        Returns the sorted unique hash keys that have postings of a song (the reverse index)
+        """
+        keys = self._song_keys.get(song_index)
+        if keys is None:
+            # songs loaded from disk: rebuild the reverse index from the postings
+            self.flush()
+            key_of_posting = np.repeat(self.keys, np.diff(self.offsets))
+            order = np.argsort(self.song_indices, kind="stable")
+            bounds = np.searchsorted(self.song_indices[order], np.arange(len(self.song_ids) + 1))
+            for i in range(len(self.song_ids)):
+                if i not in self._song_keys:
+                    self._song_keys[i] = np.unique(key_of_posting[order[bounds[i]:bounds[i + 1]]])
+            keys = self._song_keys[song_index]
+        return keys
+
+    def delete(self, song_id):
+        """
+        Deletes a song by tombstoning it; its postings are ignored by lookups and removed
+        by the next `compact`
+
+        Parameters
+        ----------
+        song_id: Hashable
+            the song's id in the artist_database
+        """
+        index = self._song_lookup.pop(song_id)
+        self.song_ids[index] = None
+        self.tombstones[index] = True
+        self._uncompacted.add(index)
+
+    def compact(self):
+        """
+        Removes the postings of deleted songs, and the keys left without postings
+
+        Notes
+        -----
+        Only the posting ranges of the deleted songs' keys (from the reverse index) are
+        searched for dead postings. Keys above `max_postings` are stop-listed (or capped)
+        first, so lowering `max_postings` takes effect at the next compaction.
+        """
+        self.flush()
+        self._limit_postings()
+        if not self._uncompacted:
+            return
+        dead_songs = sorted(self._uncompacted)
+        dead_keys = np.unique(np.concatenate([self.song_keys(i) for i in dead_songs]))
+        # keys may have been stop-listed since the reverse index was built
+        dead_keys = dead_keys[np.isin(dead_keys, self.keys, assume_unique=True)]
+        pos = np.searchsorted(self.keys, dead_keys)
+        starts = self.offsets[pos]
+        counts = self.offsets[pos + 1] - starts
+        ends = np.cumsum(counts)
+        candidates = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+
+        keep = np.ones(len(self.song_indices), dtype=bool)
+        keep[candidates[self.tombstones[self.song_indices[candidates]]]] = False
+        posting_counts = np.diff(np.concatenate([[0], np.cumsum(keep)])[self.offsets])
+
+        self.song_indices = self.song_indices[keep]
+        self.times = self.times[keep]
+        key_alive = posting_counts > 0
+        self.keys = self.keys[key_alive]
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(posting_counts[key_alive], out=self.offsets[1:])
+        for i in dead_songs:
+            self._song_keys[i] = np.empty(0, dtype=np.uint64)
+        self._uncompacted = set()
+
+    def add(self, fingerprints, abs_times, song_id):
+        """
+        Adds the fingerprints of one song
+
+        Parameters
+        ----------
+        fingerprints: Union[List[Tuple[int, int, int]], numpy.ndarray]
+            fingerprint tuples or packed hashes of the song
+        abs_times: array_like[int]
+            the absolute time of each fingerprint
+        song_id: Hashable
+            the song's id in the artist_database
+        """
+        hashes = as_hashes(fingerprints)
+        is_new = song_id not in self._song_lookup
+        index = self.song_index(song_id)
+        song_indices = np.full(len(hashes), index, dtype=np.int32)
+        self.add_many(hashes, abs_times, song_indices)
+        if is_new:
+            self._song_keys[index] = np.unique(hashes)
+
+    def add_many(self, hashes, abs_times, song_indices):
+        """
+        Bulk insert of postings, possibly from many songs
+
+        Parameters
+        ----------
+        hashes: array_like[uint64]
+            packed hash key of each posting
+        abs_times: array_like[int]
+            time of each posting
+        song_indices: array_like[int]
+            song index (see `song_index`) of each posting
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return
+        # the reverse index of these songs is rebuilt from the postings when it is needed
+        for index in np.unique(song_indices).tolist():
+            self._song_keys.pop(index, None)
+        self._pending.append((hashes,
+                              np.asarray(song_indices, dtype=np.int32),
+                              np.asarray(abs_times, dtype=np.int32)))
+
+    def flush(self):
+        """Merges all buffered postings into the CSR arrays"""
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        if len(self.stopped_keys):
+            # new postings of stop-listed keys are dropped right away
+            kept = [~np.isin(p[0], self.stopped_keys) for p in pending]
+            pending = [tuple(array[k] for array in p) for p, k in zip(pending, kept)]
+        old_keys = np.repeat(self.keys, np.diff(self.offsets))
+        all_keys = np.concatenate([old_keys] + [p[0] for p in pending])
+        all_songs = np.concatenate([self.song_indices] + [p[1] for p in pending])
+        all_times = np.concatenate([self.times] + [p[2] for p in pending])
+
+        # stable so that the postings of a key stay in insertion order
+        order = np.argsort(all_keys, kind="stable")
+        all_keys = all_keys[order]
+        self.song_indices = all_songs[order]
+        self.times = all_times[order]
+        self.keys, counts = np.unique(all_keys, return_counts=True)
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def _limit_postings(self):
+        # stop-lists (or caps) the keys that have more than `max_postings` postings
+        self.flush()
+        if self.max_postings is None:
+            return
+        counts = np.diff(self.offsets)
+        frequent = counts > self.max_postings
+        if not frequent.any():
+            return
+        if self.cap_postings:
+            rank = np.arange(len(self.song_indices)) - np.repeat(self.offsets[:-1], counts)
+            keep = rank < self.max_postings
+            counts = np.minimum(counts, self.max_postings)
+        else:
+            self.stopped_keys = np.union1d(self.stopped_keys, self.keys[frequent])
+            keep = np.repeat(~frequent, counts)
+            self.keys = self.keys[~frequent]
+            counts = counts[~frequent]
+        self.stopped_postings += len(keep) - int(np.count_nonzero(keep))
+        self.song_indices = self.song_indices[keep]
+        self.times = self.times[keep]
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def posting_counts(self):
+        """Returns the number of postings of each key of `keys` (its document frequency)"""
+        self.flush()
+        return np.diff(self.offsets)
+
+    def lookup(self, fingerprint):
+        """
+        Returns all song ids and absolute times associated with fingerprint, or None if
+        it has no entry (same as `get_id` on a dict database)
+        """
+        query_positions, song_indices, times = self.lookup_many(as_hashes([fingerprint]))
+        if len(query_positions) == 0:
+            return None
+        return [(self.song_ids[s], t) for s, t in zip(song_indices.tolist(), times.tolist())]
+
+    def lookup_many(self, hashes):
+        """
+        Looks up the postings of many hash keys at once
+
+        Parameters
+        ----------
+        hashes: array_like[uint64]
+            the query hash keys
+
+        Returns
+        -------
+        query_positions: numpy.ndarray, dtype-int64
+            the position in `hashes` of the query key each posting belongs to
+        song_indices: numpy.ndarray, dtype-int32
+            song index of each posting
+        times: numpy.ndarray, dtype-int32
+            time of each posting
+
+        Notes
+        -----
+        Hashes on the stop list (see `max_postings`) have no postings, and are counted in
+        `skipped_lookups`.
+        """
+        self.flush()
+        skipped = _count_stopped(self.stopped_keys, hashes)
+        self.skipped_lookups += skipped
+        if instrumentation.HOOKS:
+            start = time.perf_counter()
+            result = self._lookup_many(hashes)
+            instrumentation.emit("lookup", time.perf_counter() - start, queries=len(hashes), postings=len(result[0]),
+                                 skipped=skipped)
+            return result
+        return self._lookup_many(hashes)
+
+    def _lookup_many(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(self.keys) == 0 or len(hashes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        pos = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+        found = np.flatnonzero(self.keys[pos] == hashes)
+        starts = self.offsets[pos[found]]
+        counts = self.offsets[pos[found] + 1] - starts
+
+        # index of every posting of every found key, laid out key after key
+        query_positions = np.repeat(found, counts)
+        ends = np.cumsum(counts)
+        postings = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+        song_indices = self.song_indices[postings]
+        if self._uncompacted:
+            alive = ~self.tombstones[song_indices]
+            return query_positions[alive], song_indices[alive], self.times[postings[alive]]
+        return query_positions, song_indices, self.times[postings]
+
+    def match(self, fingerprints, abs_times, top_k = 1):
+        """
+        Finds the songs whose fingerprints line up best with a clip's fingerprints
+
+        Parameters
+        ----------
+        fingerprints: Union[List[Tuple[int, int, int]], numpy.ndarray]
+            fingerprint tuples or packed hashes of the clip
+        abs_times: array_like[int]
+            the time in the clip of each fingerprint
+        top_k: int
+            how many songs to return
+
+        Returns
+        -------
+        List[Tuple[Hashable, int, int]]
+            (song id, votes, offset) of the top_k songs ordered by decreasing votes,
+            where offset is the song time at which the clip starts
+        """
+        abs_times = np.asarray(abs_times, dtype=np.int64)
+        query_positions, song_indices, times = self.lookup_many(as_hashes(fingerprints))
+        offsets = times - abs_times[query_positions]
+        songs, votes, offsets = best_matches(*offset_histogram(song_indices, offsets), top_k=top_k)
+        return [(self.song_ids[s], v, o) for s, v, o in zip(songs.tolist(), votes.tolist(), offsets.tolist())]
+
+
+
+def _count_stopped(stopped_keys, hashes):
+    # number of query hashes on the (sorted) stop list
+    if len(stopped_keys) == 0:
+        return 0
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    pos = np.minimum(np.searchsorted(stopped_keys, hashes), len(stopped_keys) - 1)
+    return int(np.count_nonzero(stopped_keys[pos] == hashes))
+
+
+def _varint_encode(values):
+    # LEB128: 7 bits per byte, least significant first, high bit set on all but the last byte
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 10):
+        num_bytes += values >= np.uint64(1 << (7 * i))
+    starts = np.cumsum(num_bytes) - num_bytes
+    data = np.empty(int(num_bytes.sum()), dtype=np.uint8)
+    for i in range(int(num_bytes.max(initial=0))):
+        has_byte = num_bytes > i
+        byte = (values[has_byte] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        byte |= np.where(num_bytes[has_byte] > i + 1, np.uint64(0x80), np.uint64(0))
+        data[starts[has_byte] + i] = byte
+    return data, num_bytes
+
+
+def _varint_decode(data):
+    # inverse of `_varint_encode` for a whole number of values
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+    is_last = data < 0x80
+    value_starts = np.concatenate([[0], np.flatnonzero(is_last)[:-1] + 1])
+    position = np.arange(len(data)) - np.repeat(value_starts, np.diff(np.append(value_starts, len(data))))
+    bits = (data & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.bitwise_or.reduceat(bits, value_starts)
+
+
+def _ranges(starts, counts):
+    # concatenation of arange(start, start + count) for every (start, count)
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(np.asarray(starts, dtype=np.int64) - (ends - counts), counts)
+
+
+def _segment_cumsum(codes, segment_starts):
+    # cumsum restarting at every True of `segment_starts`, where the code is the absolute value
+    codes = codes.astype(np.int64)
+    totals = np.cumsum(codes)
+    start_positions = np.flatnonzero(segment_starts)
+    bases = (totals - codes)[start_positions]
+    lengths = np.diff(np.append(start_positions, len(codes)))
+    return totals - np.repeat(bases, lengths)
+
+
+class CompressedIndex:
+    """
+    Read-only, compressed version of a FingerprintIndex, for serving large catalogs.
+
+    The sorted keys are cut into blocks of `block_size` keys. `block_keys` holds the first
+    key of every block, and the rest of a block is one varint (LEB128) byte string in `data`:
+
+        key deltas (from the previous key)                 block_size - 1 values
+        posting count of every key                         block_size values
+        song code of every posting                         one value per posting
+        time code of every posting                         one value per posting
+
+    Inside a key the postings are sorted by (song, time). The first posting of a key
+    stores its song index, the others the difference from the previous posting's; the
+    first posting of every (key, song) run stores its time, the others the difference
+    from the previous posting's. Most codes therefore fit in one or two bytes.
+
+    A lookup decodes, with NumPy only, the blocks holding the query keys and nothing
+    else, so its cost is bounded by `block_size` keys per query key. Larger blocks
+    compress slightly better (fewer block entries) but decode more per lookup.
+
+    Build one with `CompressedIndex.from_index`; it can be saved with `save_index` and
+    passed anywhere a FingerprintIndex is queried (`get_id`, `give_matched_songid`,
+    `match_many`, `match_scored`), but songs cannot be added to or deleted from it.
+    """
+
+    def __init__(self, block_size = 16, sampling_rate = 44100, peaks_per_column = None, bands = None,
+                 target_zone = None):
+        self.block_size = block_size
+        self.sampling_rate = sampling_rate
+        self.peaks_per_column = _setting_value(peaks_per_column)
+        self.bands = _setting_value(bands)
+        self.target_zone = _setting_value(target_zone)
+        self.block_keys = np.empty(0, dtype=np.uint64)
+        self.block_bytes = np.zeros(1, dtype=np.int64)
+        self.block_postings = np.zeros(1, dtype=np.int64)
+        self.data = np.empty(0, dtype=np.uint8)
+        self.stopped_keys = np.empty(0, dtype=np.uint64)
+        self.stopped_postings = 0
+        self.skipped_lookups = 0
+        self.num_keys = 0
+        self.song_ids = []
+
+    @classmethod
+    def from_index(cls, fingerprint_index, block_size = 16):
+        """Compresses a FingerprintIndex (compacting it first)"""
+        fingerprint_index.compact()
+        compressed = cls(block_size, fingerprint_index.sampling_rate, **_index_settings(fingerprint_index))
+        compressed.song_ids = list(fingerprint_index.song_ids)
+        compressed.stopped_keys = np.asarray(fingerprint_index.stopped_keys, dtype=np.uint64)
+        compressed.stopped_postings = fingerprint_index.stopped_postings
+        keys = np.asarray(fingerprint_index.keys, dtype=np.uint64)
+        counts = np.diff(fingerprint_index.offsets)
+        num_keys = len(keys)
+        compressed.num_keys = num_keys
+        if num_keys == 0:
+            return compressed
+
+        # sort the postings of every key by (song, time)
+        key_of_posting = np.repeat(np.arange(num_keys), counts)
+        songs = np.asarray(fingerprint_index.song_indices, dtype=np.int64)
+        times = np.asarray(fingerprint_index.times, dtype=np.int64)
+        order = np.lexsort((times, songs, key_of_posting))
+        songs = songs[order]
+        times = times[order]
+
+        key_start = np.zeros(len(songs), dtype=bool)
+        key_start[fingerprint_index.offsets[:-1][counts > 0]] = True
+        song_codes = np.diff(songs, prepend=0)
+        song_codes[key_start] = songs[key_start]
+        run_start = key_start | (song_codes != 0)
+        time_codes = np.diff(times, prepend=0)
+        time_codes[run_start] = times[run_start]
+
+        # where every value goes in the concatenated blocks
+        block = np.arange(num_keys) // block_size
+        num_blocks = block[-1] + 1
+        block_first = np.arange(num_blocks) * block_size
+        keys_in_block = np.minimum(block_size, num_keys - block_first)
+        block_postings = np.zeros(num_blocks + 1, dtype=np.int64)
+        block_postings[1:] = np.cumsum(counts)[block_first + keys_in_block - 1]
+        postings_in_block = np.diff(block_postings)
+        values_in_block = 2 * keys_in_block - 1 + 2 * postings_in_block
+        value_start = np.cumsum(values_in_block) - values_in_block
+
+        values = np.empty(int(values_in_block.sum()), dtype=np.uint64)
+        slot = np.arange(num_keys) - block_first[block]
+        not_first = slot > 0
+        values[value_start[block[not_first]] + slot[not_first] - 1] = np.diff(keys)[not_first[1:]]
+        values[value_start[block] + keys_in_block[block] - 1 + slot] = counts
+        posting_block = block[key_of_posting]
+        posting_slot = np.arange(len(songs)) - block_postings[posting_block]
+        posting_base = value_start[posting_block] + 2 * keys_in_block[posting_block] - 1
+        values[posting_base + posting_slot] = song_codes
+        values[posting_base + postings_in_block[posting_block] + posting_slot] = time_codes
+
+        compressed.data, num_bytes = _varint_encode(values)
+        compressed.block_keys = keys[block_first]
+        compressed.block_bytes = np.zeros(num_blocks + 1, dtype=np.int64)
+        compressed.block_bytes[1:] = np.cumsum(num_bytes)[value_start + values_in_block - 1]
+        compressed.block_postings = block_postings
+        return compressed
+
+    def _set_song_ids(self, song_ids, uncompacted = None):
+        # a CompressedIndex is always compacted (see `from_index`)
+        self.song_ids = list(song_ids)
+
+    def __len__(self):
+        return int(self.block_postings[-1])
+
+    def __contains__(self, fingerprint):
+        return len(self.lookup_many(as_hashes([fingerprint]))[0]) > 0
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the index arrays"""
+        return self.block_keys.nbytes + self.block_bytes.nbytes + self.block_postings.nbytes + self.data.nbytes
+
+    def flush(self):
+        pass
+
+    def _decode_blocks(self, blocks):
+        # decodes blocks (sorted, unique) into their keys, posting counts, songs and times
+        block_first = blocks * self.block_size
+        keys_in_block = np.minimum(self.block_size, self.num_keys - block_first)
+        postings_in_block = self.block_postings[blocks + 1] - self.block_postings[blocks]
+        values_in_block = 2 * keys_in_block - 1 + 2 * postings_in_block
+        value_start = np.cumsum(values_in_block) - values_in_block
+        byte_starts = self.block_bytes[blocks]
+        values = _varint_decode(self.data[_ranges(byte_starts, self.block_bytes[blocks + 1] - byte_starts)])
+
+        # keys: the first key of every block, then the running sum of the deltas
+        key_deltas = np.zeros(int(keys_in_block.sum()), dtype=np.uint64)
+        key_block_start = np.cumsum(keys_in_block) - keys_in_block
+        not_first = np.ones(len(key_deltas), dtype=bool)
+        not_first[key_block_start] = False
+        key_deltas[not_first] = values[_ranges(value_start, keys_in_block - 1)]
+        key_deltas[key_block_start] = self.block_keys[blocks]
+        keys = np.cumsum(key_deltas, dtype=np.uint64)
+        keys -= np.repeat(keys[key_block_start] - key_deltas[key_block_start], keys_in_block)
+
+        counts = values[_ranges(value_start + keys_in_block - 1, keys_in_block)].astype(np.int64)
+        song_codes = values[_ranges(value_start + 2 * keys_in_block - 1, postings_in_block)]
+        time_codes = values[_ranges(value_start + 2 * keys_in_block - 1 + postings_in_block, postings_in_block)]
+
+        key_start = np.zeros(len(song_codes), dtype=bool)
+        key_start[(np.cumsum(counts) - counts)[counts > 0]] = True
+        songs = _segment_cumsum(song_codes, key_start)
+        times = _segment_cumsum(time_codes, key_start | (song_codes != 0))
+        return keys, counts, songs, times
+
+    def lookup(self, fingerprint):
+        """Same as `FingerprintIndex.lookup`"""
+        query_positions, song_indices, times = self.lookup_many(as_hashes([fingerprint]))
+        if len(query_positions) == 0:
+            return None
+        return [(self.song_ids[s], t) for s, t in zip(song_indices.tolist(), times.tolist())]
+
+    def lookup_many(self, hashes):
+        """Same as `FingerprintIndex.lookup_many`, decoding only the blocks of the query keys"""
+        skipped = _count_stopped(self.stopped_keys, hashes)
+        self.skipped_lookups += skipped
+        if instrumentation.HOOKS:
+            start = time.perf_counter()
+            result = self._lookup_many(hashes)
+            instrumentation.emit("lookup", time.perf_counter() - start, queries=len(hashes), postings=len(result[0]),
+                                 skipped=skipped)
+            return result
+        return self._lookup_many(hashes)
+
+    def _lookup_many(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.num_keys == 0 or len(hashes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        query_blocks = np.searchsorted(self.block_keys, hashes, side="right") - 1
+        blocks = np.unique(query_blocks[query_blocks >= 0])
+        if len(blocks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        keys, counts, songs, times = self._decode_blocks(blocks)
+
+        pos = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+        found = np.flatnonzero(keys[pos] == hashes)
+        offsets = np.cumsum(counts) - counts
+        postings = _ranges(offsets[pos[found]], counts[pos[found]])
+        query_positions = np.repeat(found, counts[pos[found]])
+        return query_positions, songs[postings].astype(np.int32), times[postings].astype(np.int32)
+
+    def match(self, fingerprints, abs_times, top_k = 1):
+        """Same as `FingerprintIndex.match`"""
+        abs_times = np.asarray(abs_times, dtype=np.int64)
+        query_positions, song_indices, times = self.lookup_many(as_hashes(fingerprints))
+        offsets = times - abs_times[query_positions]
+        songs, votes, offsets = best_matches(*offset_histogram(song_indices, offsets), top_k=top_k)
+        return [(self.song_ids[s], v, o) for s, v, o in zip(songs.tolist(), votes.tolist(), offsets.tolist())]
+
 
 '''
 def compare_unknown(fingerprint, fingerprint_database):
@@ -3,11 +3,84 @@
 # NumPy-array of digital samples. (Nicholas Won)
 
 import numpy as np
-from microphone import record_audio
-import librosa
 import pathlib
 
-def micsample(listentime):
+# `microphone`, `librosa`, `soundfile`, `soxr` and `scipy` are imported by the functions
+# that use them, so that the rest of wahzam can be imported without the audio stack
+
+from .instrumentation import instrumented
+
+# Landmark energy sits below ~5 kHz, so the audio can be analysed at a reduced rate (e.g.
+# 8000, 11025 or 22050 Hz) instead of 44100 Hz. `frame_params` scales the spectrogram
+# windows with the rate so that a spectrogram row is (nearly) the same frequency and a
+# column the same duration at every rate, only the rows above the new Nyquist frequency
+# are gone.
+
+def _fast_fft_size(size):
+    # the smallest even size >= `size` with no prime factor above 5, which the FFT handles
+    # about as fast as a power of two (a prime size such as 743 is several times slower)
+    size += size % 2
+    while True:
+        remainder = size
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 2
+
+def frame_params(sampling_rate = 44100):
+    """
+    Returns the (window_size, step) of the spectrogram at `sampling_rate`: the default
+    4096/2048 at 44100 Hz, scaled with the rate
+
+    The scaled window is rounded up to an FFT-friendly size (even, with no prime factor
+    above 5), and the step is half of it; e.g. 750/375 at 8000 Hz, 1024/512 at 11025 Hz.
+
+    Parameters
+    ----------
+    sampling_rate : int
+        analysis sampling rate in Hz
+
+    Returns
+    -------
+    (window_size, step) : Tuple[int, int]
+        the FFT size and the hop of `make_spectogram`
+    """
+    window_size = _fast_fft_size(max(round(4096 * sampling_rate / 44100), 2))
+    return window_size, window_size // 2
+
+def frame_seconds(sampling_rate = 44100):
+    """Returns the duration of one spectrogram column (one unit of fingerprint time) at `sampling_rate`"""
+    return frame_params(sampling_rate)[1] / sampling_rate
+
+def resample(samples, from_rate, to_rate):
+    """
+    Resamples audio with a polyphase low-pass filter (`scipy.signal.resample_poly`), e.g.
+    to decimate 44100 Hz audio to the analysis rate
+
+    Parameters
+    ----------
+    samples : numpy.ndarray, shape-(N,)
+        the audio samples
+    from_rate, to_rate : int
+        the current and the wanted sampling rate
+
+    Returns
+    -------
+    numpy.ndarray[float32]
+        the resampled samples, `samples` itself if the rates are equal
+    """
+    if from_rate == to_rate:
+        return samples
+    from math import gcd
+    from scipy.signal import resample_poly
+
+    divisor = gcd(int(from_rate), int(to_rate))
+    return resample_poly(np.asarray(samples, dtype=np.float32), to_rate // divisor, from_rate // divisor).astype(np.float32)
+
+@instrumented("micsample", lambda result: {"samples": len(result[0])})
+def micsample(listentime, sampling_rate = None):
     """
     Uses the microphone to record audio and returns a numpy array
     of digital samples
@@ -16,18 +89,34 @@ def micsample(listentime):
     ----------
     listentime : float
         length of recording in seconds
+
+    sampling_rate : Optional[int]
+        rate to resample the recording to (see `resample`), None to keep the
+        microphone's rate
         
     Returns
     -------
     (samples, times) : Tuple[ndarray, ndarray]
         the shape-(N,) array of samples and the corresponding shape-(N,) array of times
+
+    Notes
+    -----
+    The whole recording is held until it ends; for continuous listening with constant
+    memory, see `capture.MicrophoneCapture`.
     """
-    frames, sampling_rate = record_audio(listentime)
+    from microphone import record_audio
+
+    frames, recording_rate = record_audio(listentime)
     samples = np.hstack([np.frombuffer(i, np.int16) for i in frames])
+    if sampling_rate is not None and sampling_rate != recording_rate:
+        samples = resample(samples, recording_rate, sampling_rate)
+    else:
+        sampling_rate = recording_rate
     times = np.arange(samples.size) / sampling_rate
     return samples, times
 
-def filesample(filename, cliptime):
+@instrumented("filesample", lambda result: {"samples": len(result[0])})
+def filesample(filename, cliptime, sampling_rate = 44100):
     """
     Uses librosa to read in audio samples from a sound file and returns
     a numpy array of digital samples
@@ -39,20 +128,97 @@ def filesample(filename, cliptime):
 
     cliptime : float
         duration of file to sample from
+
+    sampling_rate : int
+        rate the audio is resampled to
         
     Returns
     -------
     (samples, times) : Tuple[ndarray, ndarray]
         the shape-(N,) array of samples and the corresponding shape-(N,) array of times
     """
+    import librosa
+
     p = pathlib.Path(filename)
     filepath = str(p.absolute())
-    samples, sampling_rate = librosa.load(filepath, sr=44100, mono=True, duration=cliptime)
+    samples, sampling_rate = librosa.load(filepath, sr=sampling_rate, mono=True, duration=cliptime)
     times = np.arange(samples.size) / sampling_rate
     return samples, times
 
-# OPTIONAL
-# def foldersample(foldername, cliptimes)
+def fileblocks(filename, block_seconds = 10, cliptime = None, sampling_rate = 44100):
+    """
+    Decodes a sound file block by block, so that files of any length can be processed
+    with bounded memory
+
+    Parameters
+    ----------
+    filename : string
+        file name of audio file to be analyzed
+
+    block_seconds : float
+        duration of each block, in seconds of the file
+
+    cliptime : Optional[float]
+        duration of file to sample from, None for the whole file
+
+    sampling_rate : int
+        sampling rate of the yielded samples
+
+    Yields
+    ------
+    numpy.ndarray[float32], shape-(N,)
+        the mono samples of the next block, the same samples as `filesample` reads
+
+    Notes
+    -----
+    The file is read with soundfile; when its native rate is not `sampling_rate` the
+    blocks are resampled with a streaming soxr resampler (the resampler `librosa.load`
+    uses), otherwise they are passed through untouched.
+    """
+    import soundfile
+
+    filepath = str(pathlib.Path(filename).absolute())
+    with soundfile.SoundFile(filepath) as audio_file:
+        native_rate = audio_file.samplerate
+        resampler = None
+        if native_rate != sampling_rate:
+            import soxr
+            resampler = soxr.ResampleStream(native_rate, sampling_rate, 1, dtype="float32", quality="HQ")
+
+        frames = -1 if cliptime is None else int(cliptime * native_rate)
+        blocksize = max(int(block_seconds * native_rate), 1)
+        for block in audio_file.blocks(blocksize=blocksize, frames=frames, dtype="float32", always_2d=True):
+            samples = block.mean(axis=1, dtype=np.float32)
+            if resampler is not None:
+                samples = resampler.resample_chunk(samples)
+            if samples.size:
+                yield samples
+        if resampler is not None:
+            samples = resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+            if samples.size:
+                yield samples
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac", ".aiff", ".aif")
+
+def foldersample(foldername, extensions=AUDIO_EXTENSIONS):
+    """
+    Finds all of the audio files in a folder (and its subfolders)
+
+    Parameters
+    ----------
+    foldername : string
+        name of the folder to search
+
+    extensions : Tuple[string]
+        file extensions (lowercase, including the dot) that count as audio files
+
+    Returns
+    -------
+    List[string]
+        sorted absolute paths of the audio files
+    """
+    folder = pathlib.Path(foldername).absolute()
+    return sorted(str(p) for p in folder.rglob("*") if p.is_file() and p.suffix.lower() in extensions)
 
 # OPTIONAL
 # Creating a function that can take an array of audio samples from 
@@ -1,84 +1,131 @@
 from numba import njit
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
 from typing import Tuple, List
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion, iterate_structure
-from mygrad import sliding_window_view
 
+from .instrumentation import instrumented
 
-def make_spectogram(digital_samples, times):
+
+def get_window(window, window_size, dtype = np.float64):
+    """
+    Returns the taper applied to each window of audio by `make_spectogram`
+
+    Parameters
+    ----------
+    window : Union[str, None, numpy.ndarray]
+        "hann", "hamming", "blackman", "boxcar"/None (no taper), or the window itself
+    window_size : int
+        number of samples in each window
+    dtype : numpy.dtype
+        dtype of the returned window
+
+    Returns
+    -------
+    numpy.ndarray, shape-(window_size,)
+        the (periodic) window function
+    """
+    if window is None or (isinstance(window, str) and window == "boxcar"):
+        return np.ones(window_size, dtype=dtype)
+    if not isinstance(window, str):
+        window = np.asarray(window, dtype=dtype)
+        assert window.shape == (window_size,)
+        return window
+    phase = 2 * np.pi * np.arange(window_size) / window_size
+    if window == "hann":
+        taper = 0.5 - 0.5 * np.cos(phase)
+    elif window == "hamming":
+        taper = 0.54 - 0.46 * np.cos(phase)
+    elif window == "blackman":
+        taper = 0.42 - 0.5 * np.cos(phase) + 0.08 * np.cos(2 * phase)
+    else:
+        raise ValueError(f"Unknown window function: {window}")
+    return taper.astype(dtype)
+
+
+def _amplitudes(windowed_audio, window, out = None):
+    """
+    Computes the spectrogram columns of an (..., M, N) array of windows of audio with one
+    batched rfft. Returns the (..., N // 2 + 1, M) array of amplitudes (written into `out`
+    if given).
+    """
+    N = windowed_audio.shape[-1]
+    ck_for_each_window = np.fft.rfft(windowed_audio * window, axis=-1)
+    # rows: freq, cols: time
+    spectrogram = np.absolute(np.swapaxes(ck_for_each_window, -1, -2), out=out)
+    # scale so that a sinusoid's peak has its amplitude, whatever the taper
+    spectrogram *= 2 / window.sum()
+    spectrogram[..., 0, :] /= 2
+    if N % 2 == 0:
+        spectrogram[..., -1, :] /= 2
+    return spectrogram
+
+
+@instrumented("make_spectogram", lambda spectrogram: {"columns": spectrogram.shape[-1]})
+def make_spectogram(digital_samples, times = None, window_size = 4096, step = 2048, window = "hann",
+                    dtype = np.float64, out = None):
     """
     Makes a spectogram
     
     Parameters
     ----------
-    digital_samples : numpy.ndarray, shape-(H, W)
-        numpy array of N audio samples
-    
+    digital_samples : numpy.ndarray, shape-(N,) or shape-(C, N)
+        numpy array of N audio samples, or of C equal-length clips of N samples each
+
+    times : Optional[numpy.ndarray], shape-(N,)
+        times of the samples; not needed to compute the spectrogram, accepted so that
+        the (samples, times) pairs from `digital_sampling` can be passed straight in
+
+    window_size : int
+        number of samples in each window (the FFT size)
+
+    step : int
+        number of samples between the starts of consecutive windows (the hop)
+
+    window : Union[str, None, numpy.ndarray]
+        taper applied to each window, see `get_window`
+
+    dtype : numpy.dtype
+        float32 halves the memory and compute of float64
+
+    out : Optional[numpy.ndarray], shape-([C,] window_size // 2 + 1, M)
+        buffer of `dtype` to write the spectrogram into, so that repeated calls on
+        clips of the same length do not allocate a new spectrogram every time
     
     Returns
     -------
-    spectrogram:numpy.ndarray
+    spectrogram:numpy.ndarray, shape-([C,] window_size // 2 + 1, M)
         spectrogram is the 2-D array whose rows corresponds to frequencies and whose columns correspond to time. 
-        freqs is an array of the frequency values corresponding to the rows
-        times is an array of time values corresponding to the columns.
+        Use `spectrogram_axes` for the frequency and time values of the rows and columns.
+        For a stack of clips, the spectrogram of each clip is stacked along the first axis.
+
+    Notes
+    -----
+    The windows are a strided view of the samples (no copy) and all of them, from
+    all of the clips, are transformed by a single batched rfft.
     """
-   
-    # The desired temporal duration (seconds) of each window of audio data
-    recorded_dt = np.diff(times)[0]
-    window_dt = recorded_dt  # you can adjust this value later
-
-
-    # Compute the number of samples that should fit in each
-    # window, so that each temporal window has a duration of `window_dt`
-    # Hint: remember that the audio samples have an associated
-    # sampling rate of 44100 samples per second
-
-    # Define this as `window_size` (an int)
-    # <COGINST>
-    extend_factor = 1  # adjust this later for trying overlapping windows
-    window_dt *= extend_factor
-    window_size = int(window_dt * 44100)
-    # </COGINST>
-
-    # Using the above window size and `sliding_window_view`, create an array 
-    # of non-overlapping windows of the audio data.
-    # What should the step-size be so that the windows are non-overlapping?
-
-    # Define `windowed_audio` to be a 2D array where each row contains the
-    # samples of the recording in a temporal window.
-    # The shape should be (M, N), where M is the number of temporal windows
-    # and N is the number of samples in each window
-    # <COGINST>
-    windowed_audio = sliding_window_view(
-        digital_samples, window_shape=(window_size,), step=window_size // extend_factor
+    digital_samples = np.ascontiguousarray(digital_samples, dtype=dtype)
+    # number of complete windows
+    M = max(0, (digital_samples.shape[-1] - window_size) // step + 1)
+    stride = digital_samples.strides[-1]
+    windowed_audio = np.lib.stride_tricks.as_strided(
+        digital_samples, shape=digital_samples.shape[:-1] + (M, window_size),
+        strides=digital_samples.strides[:-1] + (step * stride, stride), writeable=False
     )
+    return _amplitudes(windowed_audio, get_window(window, window_size, dtype), out=out).astype(dtype, copy=False)
 
-    M, N = windowed_audio.shape
-    ck_for_each_window = np.fft.rfft(windowed_audio, axis=-1)
-    ak_for_each_window = np.absolute(ck_for_each_window) / N
-    ak_for_each_window[:, 1 : (-1 if N % 2 == 0 else None)] *= 2
-    spectrogram = ak_for_each_window.T  # rows: freq, cols: time
-    return spectrogram
-    # ! You need to take a look at Nicholas's work and get the sampled audio from there rather than taking
-    # ! Purely the recorded audio and sampling rate
-    
-    
-    
-    # S, freqs, times = mlab.specgram(
-    #     recorded_audio,
-    #     NFFT=4096,
-    #     Fs=sampling_rate,
-    #     window=mlab.window_hanning,
-    #     noverlap=4096 // 2,
-    #     mode='magnitude'
-    # )
-    #return S, freqs, times
 
+def spectrogram_axes(spectrogram, sampling_rate = 44100, window_size = 4096, step = 2048):
+    """
+    Returns the frequency (Hz) of each row and the time (seconds, at the start of the
+    window) of each column of a spectrogram made by `make_spectogram`
+    """
+    freqs = np.fft.rfftfreq(window_size, d=1 / sampling_rate)
+    times = np.arange(spectrogram.shape[1]) * step / sampling_rate
+    return freqs, times
 
 
-@njit
+# cache=True stores the compiled kernel next to this module, so only the very first process
+# pays for the compilation (see `warm_start`)
+@njit(cache=True)
 def _peaks(
     data_2d: np.ndarray, rows: np.ndarray, cols: np.ndarray, amp_min: float
 ) -> List[Tuple[int, int]]:
@@ -142,12 +189,173 @@ def _peaks(
             peaks.append((r, c))
     return peaks
 
+def warm_start():
+    """
+    Compiles (or loads from the on-disk cache) the Numba kernel of `local_peak_locations`
+    for float64 and float32 spectrograms, so that the first real query does not pay for it.
+
+    Numba compiles one kernel per memory layout: the spectrograms of `make_spectogram` are
+    Fortran-ordered, so the kernel is warmed on one of those (and on a C-ordered copy, for
+    spectrograms made some other way).
+
+    Meant to be run once per process, e.g. as the initializer of a worker pool.
+    """
+    noise = np.random.default_rng(0).standard_normal(256)
+    for dtype in (np.float64, np.float32):
+        spectrogram = make_spectogram(noise, window_size = 64, step = 32, dtype = dtype)
+        for data_2d in (spectrogram, np.ascontiguousarray(spectrogram)):
+            local_peak_locations(data_2d, cutoff = 1)
+
+def neighborhood_offsets(cutoff = 20):
+    """
+    Builds the diamond-shaped neighborhood used by `local_peak_locations`
+
+    Parameters
+    ----------
+    cutoff : int
+        radius of the neighborhood (number of times the connectivity-1 structure is iterated)
+
+    Returns
+    -------
+    (rows, cols) : Tuple[numpy.ndarray, numpy.ndarray]
+        the 0-centered row and column indices of the neighborhood mask, as used by `_peaks`
+    """
+    # the cutoff-fold dilation of the 3x3 cross (scipy's `iterate_structure`) is the diamond
+    # |dr| + |dc| <= cutoff; like `iterate_structure`, a cutoff below 1 still means the cross
+    radius = max(cutoff, 1)
+    dr, dc = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    neighborhood = np.abs(dr) + np.abs(dc) <= radius
+    rows, cols = np.where(neighborhood)
+    assert neighborhood.shape[0] % 2 == 1
+    assert neighborhood.shape[1] % 2 == 1
+
+    # center neighborhood indices around center of neighborhood
+    rows -= neighborhood.shape[0] // 2
+    cols -= neighborhood.shape[1] // 2
+    return rows, cols
+
+def _peaks_max_filter(data_2d: np.ndarray, cutoff: int, amp_min: float) -> np.ndarray:
+    """
+    Max-filter 2-D peak-finding, equivalent to `_peaks` with the `neighborhood_offsets(cutoff)`
+    neighborhood.
+
+    A datum is a peak when it is above `amp_min` and equal to the maximum of its neighborhood.
+    The diamond neighborhood is the `cutoff`-fold dilation of the 3x3 cross, so its max filter
+    is computed as `cutoff` vectorized passes of the 5-element cross max filter instead of one
+    pass of the (2 * cutoff + 1)**2 / 2 element diamond.
+
+    Parameters
+    ----------
+    data_2d : numpy.ndarray, shape-(H, W)
+        The 2D array of data in which local peaks will be detected.
+
+    cutoff : int
+        radius of the diamond neighborhood
+
+    amp_min : float
+        All amplitudes at and below this value are excluded from being local
+        peaks.
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 2)
+        (row, col) index pair for each local peak location, in column-major order.
+    """
+    # like `iterate_structure`, a cutoff below 1 still means the cross itself
+    neighborhood_max = data_2d
+    for _ in range(max(cutoff, 1)):
+        # max over the 3x3 cross; neighbors outside of the array are ignored, like in `_peaks`
+        # (a staircase path between two points of the array never leaves it, so the iterated
+        # cross still covers the full diamond near the boundary)
+        previous = neighborhood_max
+        neighborhood_max = previous.copy()
+        np.maximum(neighborhood_max[1:], previous[:-1], out=neighborhood_max[1:])
+        np.maximum(neighborhood_max[:-1], previous[1:], out=neighborhood_max[:-1])
+        np.maximum(neighborhood_max[:, 1:], previous[:, :-1], out=neighborhood_max[:, 1:])
+        np.maximum(neighborhood_max[:, :-1], previous[:, 1:], out=neighborhood_max[:, :-1])
+
+    is_peak = (data_2d > amp_min) & (data_2d >= neighborhood_max)
+    # transposing makes np.nonzero walk the columns in order
+    cols, rows = np.nonzero(is_peak.T)
+    return np.stack([rows, cols], axis=-1)
+
+
+def band_edges(num_rows, bands):
+    """
+    Returns the row edges of the frequency bands used by `top_peaks_per_column`
+
+    Parameters
+    ----------
+    num_rows : int
+        number of frequency rows of the spectrogram
+    bands : Union[int, Sequence[int]]
+        number of equal-width bands, or the first row of every band
+
+    Returns
+    -------
+    numpy.ndarray, shape-(B + 1,)
+        the first row of every band, followed by `num_rows`
+
+    Raises
+    ------
+    ValueError
+        if the first rows do not start at 0 and increase below `num_rows`
+    """
+    if np.ndim(bands) == 0:
+        if int(bands) < 1:
+            raise ValueError("bands must be at least 1")
+        return np.linspace(0, num_rows, int(bands) + 1).astype(np.int64)
+    edges = np.append(np.asarray(bands, dtype=np.int64), num_rows)
+    if len(edges) < 2 or edges[0] != 0 or np.any(np.diff(edges) <= 0):
+        raise ValueError(f"bands must start at row 0 and increase below {num_rows}, not {list(bands)}")
+    return edges
+
+def top_peaks_per_column(peaks, data_2d, peaks_per_column, bands = None):
+    """
+    Keeps only the `peaks_per_column` largest peaks of every spectrogram column, or of
+    every band of every column
+
+    Parameters
+    ----------
+    peaks : numpy.ndarray, shape-(N, 2)
+        (row, col) of the peaks, as returned by `local_peak_locations`
+    data_2d : numpy.ndarray, shape-(H, W)
+        the data the peaks were found in
+    peaks_per_column : int
+        number of peaks kept per column (per band)
+    bands : Optional[Union[int, Sequence[int]]]
+        frequency bands (see `band_edges`), None for one band spanning the whole column
+
+    Returns
+    -------
+    numpy.ndarray, shape-(M, 2)
+        the kept peaks, in the order they were given
+    """
+    if len(peaks) == 0:
+        return peaks
+    group = peaks[:, 1]
+    if bands is not None:
+        edges = band_edges(data_2d.shape[0], bands)
+        band = np.searchsorted(edges, peaks[:, 0], side="right") - 1
+        group = group * (len(edges) - 1) + band
+
+    # sort by group, loudest first, and keep the first peaks_per_column of every group
+    order = np.lexsort((-data_2d[peaks[:, 0], peaks[:, 1]], group))
+    sorted_group = group[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_group, sorted_group)
+    keep = np.zeros(len(peaks), dtype=bool)
+    keep[order[rank < peaks_per_column]] = True
+    return peaks[keep]
+
+
 # # `local_peak_locations` is responsible for taking in the boolean mask `neighborhood`
 # # and converting it to a form that can be used by `_peaks`. This "outer" code is 
 # # not compatible with Numba which is why we end up using two functions:
 # # `local_peak_locations` does some initial pre-processing that is not compatible with
 # # Numba, and then it calls `_peaks` which contains all of the jit-compatible code
-def local_peak_locations(data_2d: np.ndarray, amp_min_percentile = 75, cutoff = 20): #should be 20, just messin around
+@instrumented("local_peak_locations", lambda peaks: {"peaks": len(peaks)})
+def local_peak_locations(data_2d: np.ndarray, amp_min_percentile = 75, cutoff = 20, method = "numba",
+                         peaks_per_column = None, bands = None): #should be 20, just messin around
     """
     Defines a local neighborhood and finds the local peaks
     in the spectrogram, which must be larger than the specified `amp_min`.
@@ -156,44 +364,59 @@ def local_peak_locations(data_2d: np.ndarray, amp_min_percentile = 75, cutoff =
     ----------
     data_2d : numpy.ndarray, shape-(H, W)
         The 2D array of data in which local peaks will be detected
-    
-    neighborhood : numpy.ndarray, shape-(h, w)
-        A boolean mask indicating the "neighborhood" in which each
-        datum will be assessed to determine whether or not it is
-        a local peak. h and w must be odd-valued numbers
-        
-    amp_min : float
-        All amplitudes at and below this value are excluded from being local 
-        peaks.
+
+    amp_min_percentile : float
+        Percentile of the log-amplitudes at and below which data are excluded
+        from being local peaks.
+
+    cutoff : int
+        Radius of the diamond-shaped neighborhood in which each datum will be
+        assessed to determine whether or not it is a local peak.
+
+    method : str
+        "numba" to scan the neighborhood of every datum with `_peaks`, or
+        "max_filter" to compare the data with its neighborhood maximum
+        (`_peaks_max_filter`). Both give the same peaks.
+
+    peaks_per_column : Optional[int]
+        if given, only the largest `peaks_per_column` peaks of every column (of every
+        band of every column, see `bands`) are kept, which bounds the number of peaks
+        per second whatever the loudness of the audio (see `top_peaks_per_column`)
+
+    bands : Optional[Union[int, Sequence[int]]]
+        number of equal-width frequency bands, or the first row of every band, that
+        `peaks_per_column` applies to separately; None for the whole column
     
     Returns
     -------
-    List[Tuple[int, int]]
+    numpy.ndarray, shape-(N, 2)
         (row, col) index pair for each local peak location.
     
     Notes
     -----
-    Neighborhoods that overlap with the boundary are mirrored across the boundary.
+    Neighbors that fall outside of the boundary are ignored.
     
     The local peaks are returned in column-major order.
     """
+    if data_2d.size == 0:
+        # e.g. a clip shorter than one spectrogram window
+        return np.empty((0, 2), dtype=np.int64)
     #Amp Min Calculate
     data_2d = np.clip(data_2d, 1e-20, None)
     log_S = np.log(data_2d).ravel()  # flattened array
-    ind = round(len(log_S) * 0.01*  amp_min_percentile)
+    ind = min(round(len(log_S) * 0.01*  amp_min_percentile), len(log_S) - 1)
     amp_min = np.partition(log_S, ind)[ind]
     soklasklutch = np.log(data_2d)
-    struct = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, cutoff)
-    rows, cols = np.where(neighborhood)
-    assert neighborhood.shape[0] % 2 == 1
-    assert neighborhood.shape[1] % 2 == 1
-
-    # center neighborhood indices around center of neighborhood
-    rows -= neighborhood.shape[0] // 2
-    cols -= neighborhood.shape[1] // 2
-    print(len(_peaks(soklasklutch, rows, cols, amp_min=amp_min)))
-    return _peaks(soklasklutch, rows, cols, amp_min=amp_min)
+    if method == "numba":
+        rows, cols = neighborhood_offsets(cutoff)
+        peaks = np.array(_peaks(soklasklutch, rows, cols, amp_min=amp_min), dtype=np.int64).reshape(-1, 2)
+    elif method == "max_filter":
+        peaks = _peaks_max_filter(soklasklutch, cutoff, amp_min)
+    else:
+        raise ValueError(f"Unknown peak-finding method: {method}")
+    if peaks_per_column is not None:
+        peaks = top_peaks_per_column(peaks, soklasklutch, peaks_per_column, bands)
+    return peaks
 
 
 
@@ -1,14 +1,17 @@
 import numpy as np
 
+from .instrumentation import instrumented
+
                          
+@instrumented("findsfingerprints", lambda result: {"fingerprints": len(result[0])})
 def findsfingerprints(peakindices, fanoutsize = 15):
     """
         Takes in list of indices of peaks, returns list of fingerprint tuples
 
         Parameters
         ----------
-        peakincides : List[Tuple(int, int)]
-            The array of data containing the tuple indices of the peaks.
+        peakincides : Union[List[Tuple(int, int)], numpy.ndarray]
+            The array of data containing the tuple indices of the peaks (list of tuples or shape-(N, 2) array).
         fanoutsize : int
             Optional parameter, default of 15. How many numbers the peak in question should be compared to.
 
@@ -20,6 +23,9 @@ def findsfingerprints(peakindices, fanoutsize = 15):
             List of time values corresponding to each fingerprint, returned in the order the peaks are given
         """
 
+    if isinstance(peakindices, np.ndarray):
+        peakindices = peakindices.tolist()  #plain ints, so the fingerprint tuples are plain ints too
+
     prints = []                   #list to be filled with fingerprints
     init_times = []               #list to be filled with initial times for above fingerprints 
 
@@ -33,7 +39,6 @@ def findsfingerprints(peakindices, fanoutsize = 15):
                 timefinal = peakindices[i+j+1][1] - time1     #relative time between peak i and j
                 prints.append((freq1,freq2,timefinal))        #add tuple to prints list
                 init_times.append(time1)                      #add absolute time to list containing absolute time per fingerprint
-    print(len(prints))
     return prints, init_times
 
 
@@ -41,4 +46,165 @@ def findsfingerprints(peakindices, fanoutsize = 15):
 # print(findsfingerprints(testindices, 3))
 
 
-#the _peaks() function that generates these indices as shown in the jupyter nbs should return them already ordered by increasing row then increasing column, this function should work with that
\ No newline at end of file
+#the _peaks() function that generates these indices as shown in the jupyter nbs should return them already ordered by increasing row then increasing column, this function should work with that
+
+# Bit layout of a packed fingerprint hash: | f1 (20 bits) | f2 (20 bits) | dt (24 bits) |
+FREQ_BITS = 20
+DT_BITS = 24
+
+
+def pack_fingerprints(freq1, freq2, dt):
+    """
+    Packs (f1, f2, dt) fingerprint components into single integer hash keys
+
+    Parameters
+    ----------
+    freq1 : array_like[int]
+        frequency index of the anchor peak of each fingerprint
+    freq2 : array_like[int]
+        frequency index of the paired peak of each fingerprint
+    dt : array_like[int]
+        time index difference between the paired peak and the anchor peak
+
+    Returns
+    -------
+    numpy.ndarray, dtype-uint64
+        the packed hash key of each fingerprint
+    """
+    freq1 = np.asarray(freq1, dtype=np.uint64)
+    freq2 = np.asarray(freq2, dtype=np.uint64)
+    dt = np.asarray(dt, dtype=np.uint64)
+    return (freq1 << np.uint64(FREQ_BITS + DT_BITS)) | (freq2 << np.uint64(DT_BITS)) | dt
+
+
+def unpack_fingerprints(hashes):
+    """
+    Inverse of `pack_fingerprints`
+
+    Parameters
+    ----------
+    hashes : array_like[uint64]
+        packed hash keys
+
+    Returns
+    -------
+    numpy.ndarray, shape-(N, 3)
+        the (f1, f2, dt) components of each hash
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    freq_mask = np.uint64((1 << FREQ_BITS) - 1)
+    dt_mask = np.uint64((1 << DT_BITS) - 1)
+    freq1 = (hashes >> np.uint64(FREQ_BITS + DT_BITS)) & freq_mask
+    freq2 = (hashes >> np.uint64(DT_BITS)) & freq_mask
+    dt = hashes & dt_mask
+    return np.stack([freq1, freq2, dt], axis=-1).astype(np.int64)
+
+
+@instrumented("fingerprint_hashes", lambda result: {"fingerprints": len(result[0])})
+def fingerprint_hashes(peakindices, fanoutsize = 15):
+    """
+    Vectorized version of `findsfingerprints`: takes in the indices of peaks and returns
+    the packed hash key and anchor time of every fingerprint
+
+    Parameters
+    ----------
+    peakindices : Union[List[Tuple[int, int]], numpy.ndarray]
+        The (row, col) indices of the peaks, ordered by column major. Either a list of
+        tuples or a shape-(N, 2) integer array.
+    fanoutsize : int
+        Optional parameter, default of 15. How many numbers the peak in question should be compared to.
+
+    Returns
+    -------
+    numpy.ndarray, shape-(M,), dtype-uint64
+        packed (fi, fj, tj-ti) hash key of each fingerprint (see `pack_fingerprints`)
+    numpy.ndarray, shape-(M,), dtype-int32
+        anchor time of each fingerprint
+
+    Notes
+    -----
+    The fingerprints are produced in the same order as `findsfingerprints`, so
+    `unpack_fingerprints(hashes)` reproduces its list of tuples.
+    """
+    peaks = np.asarray(peakindices, dtype=np.int64).reshape(-1, 2)
+    num_peaks = len(peaks)
+
+    # row i holds the indices of the `fanoutsize` peaks following peak i
+    partners = np.arange(num_peaks)[:, None] + np.arange(1, fanoutsize + 1)[None, :]
+    valid = partners < num_peaks
+    anchors = np.broadcast_to(np.arange(num_peaks)[:, None], partners.shape)[valid]
+    partners = partners[valid]
+
+    freq1 = peaks[anchors, 0]
+    freq2 = peaks[partners, 0]
+    init_times = peaks[anchors, 1]
+    dt = peaks[partners, 1] - init_times
+    hashes = pack_fingerprints(freq1, freq2, dt)
+    return np.ascontiguousarray(hashes), np.ascontiguousarray(init_times, dtype=np.int32)
+
+
+@instrumented("target_zone_hashes", lambda result: {"fingerprints": len(result[0])})
+def target_zone_hashes(peakindices, t_min = 1, t_max = 64, f_max = 256, max_pairs = 15, chunk_size = 2**20):
+    """
+    Target-zone pairing: like `fingerprint_hashes`, but each anchor peak is only paired
+    with the peaks inside its target zone, t_min <= tj - ti <= t_max and |fj - fi| <= f_max,
+    taking at most `max_pairs` of them (the earliest ones)
+
+    Parameters
+    ----------
+    peakindices : Union[List[Tuple[int, int]], numpy.ndarray]
+        The (row, col) indices of the peaks, ordered by column major. Either a list of
+        tuples or a shape-(N, 2) integer array.
+    t_min, t_max : int
+        range of the time difference (in spectrogram columns) between an anchor and its partners
+    f_max : int
+        largest frequency difference (in spectrogram rows) between an anchor and its partners
+    max_pairs : int
+        largest number of fingerprints per anchor
+    chunk_size : int
+        number of candidate pairs examined at once, which bounds the temporary memory
+
+    Returns
+    -------
+    numpy.ndarray, shape-(M,), dtype-uint64
+        packed (fi, fj, tj-ti) hash key of each fingerprint (see `pack_fingerprints`)
+    numpy.ndarray, shape-(M,), dtype-int32
+        anchor time of each fingerprint
+
+    Notes
+    -----
+    The time range of every target zone is found with two `np.searchsorted` calls over the
+    (time-sorted) peaks; the candidates of a chunk of anchors are then laid out anchor
+    after anchor, filtered on frequency, and ranked within their anchor to apply `max_pairs`.
+    """
+    peaks = np.asarray(peakindices, dtype=np.int64).reshape(-1, 2)
+    freqs = peaks[:, 0]
+    times = peaks[:, 1]
+
+    # candidate partners of anchor i are the peaks lo[i]:hi[i]
+    lo = np.searchsorted(times, times + t_min, side="left")
+    hi = np.searchsorted(times, times + t_max, side="right")
+    counts = hi - lo
+
+    anchor_parts = []
+    partner_parts = []
+    step = max(chunk_size // max(int(counts.max(initial=0)), 1), 1)
+    for start in range(0, len(peaks), step):
+        chunk_counts = counts[start:start + step]
+        ends = np.cumsum(chunk_counts)
+        anchors = np.repeat(np.arange(start, start + len(chunk_counts)), chunk_counts)
+        partners = np.arange(ends[-1]) + np.repeat(lo[start:start + step] - (ends - chunk_counts), chunk_counts)
+
+        # a t_min of 0 also offers the anchor itself and the peaks of its column before it
+        in_zone = (np.abs(freqs[partners] - freqs[anchors]) <= f_max) & (partners > anchors)
+        anchors = anchors[in_zone]
+        partners = partners[in_zone]
+        rank = np.arange(len(anchors)) - np.searchsorted(anchors, anchors)
+        anchor_parts.append(anchors[rank < max_pairs])
+        partner_parts.append(partners[rank < max_pairs])
+
+    anchors = np.concatenate(anchor_parts) if anchor_parts else np.empty(0, dtype=np.int64)
+    partners = np.concatenate(partner_parts) if partner_parts else np.empty(0, dtype=np.int64)
+    init_times = times[anchors]
+    hashes = pack_fingerprints(freqs[anchors], freqs[partners], times[partners] - init_times)
+    return np.ascontiguousarray(hashes), np.ascontiguousarray(init_times, dtype=np.int32)
@@ -0,0 +1,88 @@
+# Optional instrumentation of the recognition pipeline. Every stage reports its wall time and
+# its counts (peaks, fingerprints, postings touched, candidates...) to the registered hooks:
+#
+#   registry = MetricsRegistry()
+#   add_hook(registry)
+#   query_database(...)
+#   registry.summary()  # {"make_spectogram": {"calls": 1, "seconds": ..., "columns": ...}, ...}
+#
+# With no hook registered a stage only pays for one check of an empty list.
+
+import functools
+import time
+
+# callables hook(stage, seconds, counts); see `add_hook`
+HOOKS = []
+
+
+def add_hook(hook):
+    """
+    Registers a hook that is called after every instrumented stage
+
+    Parameters
+    ----------
+    hook : Callable[[str, float, Dict[str, int]], None]
+        called as hook(stage, seconds, counts) with the name of the stage, its wall time in
+        seconds and its counts (e.g. {"peaks": 512})
+    """
+    HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """Unregisters a hook registered with `add_hook`"""
+    HOOKS.remove(hook)
+
+
+def emit(stage, seconds, **counts):
+    """Reports one run of a stage to every hook"""
+    for hook in HOOKS:
+        hook(stage, seconds, counts)
+
+
+def instrumented(stage, counts = None):
+    """
+    Decorator reporting every call of the decorated function as a run of `stage`
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage
+    counts : Optional[Callable[[Any], Dict[str, int]]]
+        computes the counts of a run from the function's return value
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not HOOKS:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            emit(stage, seconds, **(counts(result) if counts is not None else {}))
+            return result
+        return wrapper
+    return decorator
+
+
+class MetricsRegistry:
+    """
+    A hook (see `add_hook`) that accumulates, per stage, the number of calls, the total
+    wall time and the totals of the counts
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stage, seconds, counts):
+        metrics = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+        metrics["calls"] += 1
+        metrics["seconds"] += seconds
+        for name, count in counts.items():
+            metrics[name] = metrics.get(name, 0) + count
+
+    def summary(self):
+        """Returns {stage: {"calls": ..., "seconds": ..., <count>: ...}}"""
+        return {stage: dict(metrics) for stage, metrics in self.stages.items()}
+
+    def reset(self):
+        self.stages = {}
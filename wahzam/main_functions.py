@@ -2,24 +2,30 @@
 # distinguishes the different processes involved with sound-recognition
 
 import numpy as np
-from microphone import record_audio
-import librosa
 import pathlib
 import pickle
+import json
+import os
+import time
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from .databases import *
+from .databases import _analysis_rate, _fingerprint_settings
 from .find_peaks import *
 from .fingerprint import *
 from .digital_sampling import *
+from .streaming import StreamingFingerprinter
+from .cache import array_digest, file_digest
 
-def digital_sample():
+def digital_sample(sampling_rate = 44100):
     """
     Prompts the user for a file or microphone recording to be used in populating/querying the database
 
     Parameters
     ----------
-    None 
+    sampling_rate : int
+        analysis sampling rate the recording is resampled to (see `frame_params`)
 
     Returns
     ------
@@ -33,11 +39,11 @@ def digital_sample():
     if recording_type == 0:
         filename = input("What's the name of the desired audio file? (Include file extension): ")
         cliptime = int(input("How many seconds should the audio file be sampled for? "))
-        samples, times = filesample(filename, cliptime)
+        samples, times = filesample(filename, cliptime, sampling_rate)
     # Microphone Recording Sample
     elif recording_type == 1:
         listentime = int(input("How many seconds should the microphone record? "))
-        samples, times = micsample(listentime)
+        samples, times = micsample(listentime, sampling_rate)
     # Invalid Option
     else:
         print("Error: Invalid Option")  
@@ -69,8 +75,9 @@ def initialize_database():
     else:
         print("Error: Invalid Option") 
     return database
-    
-def query_database(samples, times, fingerprint_database, artist_database, amp_min_percent = 75, cutoff = 20): 
+
+def query_database(samples, times, fingerprint_database, artist_database, amp_min_percent = 75, cutoff = 20,
+                   sampling_rate = None, peaks_per_column = None, bands = None, target_zone = None): 
     """
     Finds spectrogram, peaks, and fingerprints from given digital sample and returns final song ID
 
@@ -81,6 +88,14 @@ def query_database(samples, times, fingerprint_database, artist_database, amp_mi
         
     times : ndarray
         the shape-(N,) array of times
+
+    sampling_rate : Optional[int]
+        sampling rate of the samples, defaults to that of the database
+
+    peaks_per_column, bands, target_zone
+        peak budget per spectrogram column (see `local_peak_locations`) and target zone
+        (see `sample_fingerprints`), default to those of the database (different ones
+        raise ValueError)
         
     Returns
     ------
@@ -91,17 +106,24 @@ def query_database(samples, times, fingerprint_database, artist_database, amp_mi
     if(samples.size == 0 or times.size == 0):
         return tuple()
     # Make spectrogram
-    spectrogram = make_spectogram(samples, times)
+    sampling_rate = _analysis_rate(fingerprint_database, sampling_rate)
+    settings = _fingerprint_settings(fingerprint_database, peaks_per_column = peaks_per_column, bands = bands,
+                                     target_zone = target_zone)
+    target_zone = settings.pop("target_zone")
+    spectrogram = make_spectogram(samples, times, *frame_params(sampling_rate))
     # Find peaks
-    peak_indices = local_peak_locations(spectrogram, amp_min_percent, cutoff)
-    # Find fingerprints
-    prints, init_times = findsfingerprints(peak_indices, fanoutsize = 15)
+    peak_indices = local_peak_locations(spectrogram, amp_min_percent, cutoff, **settings)
+    # Find fingerprints (packed hashes for an array-backed index)
+    prints, init_times = _pair_peaks(peak_indices, 15, target_zone, as_tuples = isinstance(fingerprint_database, dict))
     # Get song id and song info from databases, return guesses song
     final_song_id = give_matched_songid(prints, fingerprint_database, init_times)
+    if final_song_id is None:
+        return tuple()
     final_song_info = get_info(final_song_id, artist_database)
     return final_song_info
 
-def populate_database(songname, artistname, samples, times, fingerprint_database, artist_database, amp_min_percent = 75, cutoff = 20):
+def populate_database(songname, artistname, samples, times, fingerprint_database, artist_database, amp_min_percent = 75, cutoff = 20,
+                      sampling_rate = None, cache = None, peaks_per_column = None, bands = None, target_zone = None):
     """
     Populate the dictionary database 
 
@@ -119,8 +141,17 @@ def populate_database(songname, artistname, samples, times, fingerprint_database
         List of each fingerprint for the song corresponding to songid
     artist_database: Dict
         Database that maps songid to artist name and song name
-    fingerprint_database: dictionary
+    fingerprint_database: Union[dict, FingerprintIndex]
         database of the fingerprints
+    sampling_rate: Optional[int]
+        sampling rate of the samples, defaults to that of the database
+    cache: Optional[FingerprintCache]
+        cache of the peaks, keyed by the contents of the samples and the peak parameters,
+        so that re-adding the same audio skips the spectrogram and the peak search
+    peaks_per_column, bands, target_zone
+        peak budget per spectrogram column (see `local_peak_locations`) and target zone
+        (see `sample_fingerprints`), default to those of the database (different ones
+        raise ValueError)
     
     Returns
     ------
@@ -128,10 +159,386 @@ def populate_database(songname, artistname, samples, times, fingerprint_database
         The two populated databases
 
     """
-    spec = make_spectogram(samples,times)
-    peakindices = local_peak_locations(spec, amp_min_percent, cutoff)
-    fingerprints, init_times = findsfingerprints(peakindices, fanoutsize = 15)
+    sampling_rate = _analysis_rate(fingerprint_database, sampling_rate)
+    settings = _fingerprint_settings(fingerprint_database, peaks_per_column = peaks_per_column, bands = bands,
+                                     target_zone = target_zone)
+    target_zone = settings.pop("target_zone")
+    cached = None
+    if cache is not None:
+        digest = array_digest(samples)
+        peaks_params = dict(settings, sampling_rate = sampling_rate, amp_min_percent = amp_min_percent, cutoff = cutoff)
+        cached = cache.get("peaks", digest, peaks_params)
+    if cached is not None:
+        peakindices = cached[0]
+    else:
+        spec = make_spectogram(samples, times, *frame_params(sampling_rate))
+        peakindices = local_peak_locations(spec, amp_min_percent, cutoff, **settings)
+        if cache is not None:
+            cache.put("peaks", digest, peaks_params, [peakindices])
+    fingerprints, init_times = _pair_peaks(peakindices, 15, target_zone,
+                                           as_tuples = isinstance(fingerprint_database, dict))
     
     #add_artist_info(songname, artistname, artist_database)
     add_song(fingerprints, init_times, songname, artistname, artist_database, fingerprint_database)
-    return [artist_database, fingerprint_database]
\ No newline at end of file
+    return [artist_database, fingerprint_database]
+
+def sample_fingerprints(samples, times, amp_min_percent = 75, cutoff = 20, fanoutsize = 15, peaks_per_column = None,
+                        bands = None, target_zone = None, sampling_rate = 44100):
+    """
+    Finds spectrogram, peaks, and packed fingerprint hashes of a digital sample
+
+    Parameters
+    ----------
+    samples : ndarray
+        the shape-(N,) array of samples
+    times : ndarray
+        the shape-(N,) array of times
+    peaks_per_column, bands
+        peak budget per spectrogram column (see `local_peak_locations`)
+    target_zone : Optional[Tuple[int, int, int]]
+        (t_min, t_max, f_max) to pair every peak with at most `fanoutsize` peaks of its
+        target zone (see `target_zone_hashes`) instead of the next `fanoutsize` peaks
+    sampling_rate : int
+        sampling rate of the samples (see `frame_params`)
+
+    Returns
+    ------
+    (hashes, init_times) : Tuple[ndarray, ndarray]
+        the packed hash of each fingerprint and the time of its anchor peak
+    """
+    spec = make_spectogram(samples, times, *frame_params(sampling_rate))
+    peakindices = local_peak_locations(spec, amp_min_percent, cutoff, peaks_per_column = peaks_per_column,
+                                       bands = bands)
+    return _pair_peaks(peakindices, fanoutsize, target_zone)
+
+def _pair_peaks(peakindices, fanoutsize, target_zone = None, as_tuples = False):
+    # Fingerprints of the peaks, paired with the next `fanoutsize` peaks or with at most
+    # `fanoutsize` peaks of their target zone; as (f1, f2, dt) tuples for a dict database
+    # if as_tuples, else as packed hashes
+    if target_zone is None:
+        if as_tuples:
+            return findsfingerprints(peakindices, fanoutsize = fanoutsize)
+        return fingerprint_hashes(peakindices, fanoutsize = fanoutsize)
+    t_min, t_max, f_max = target_zone
+    hashes, init_times = target_zone_hashes(peakindices, t_min, t_max, f_max, max_pairs = fanoutsize)
+    if as_tuples:
+        return [tuple(fingerprint) for fingerprint in unpack_fingerprints(hashes).tolist()], init_times.tolist()
+    return hashes, init_times
+
+def file_fingerprints(filename, cliptime = None, amp_min_percent = 75, cutoff = 20, fanoutsize = 15, block_seconds = 10,
+                      sampling_rate = 44100):
+    """
+    Finds the packed fingerprint hashes of a sound file while it is being decoded, for
+    files too long to hold in memory (e.g. DJ sets or radio archives)
+
+    Parameters
+    ----------
+    filename : string
+        file name of audio file to be analyzed
+    cliptime : Optional[float]
+        duration of file to sample from, None for the whole file
+    block_seconds : float
+        duration of the blocks the file is decoded in (see `fileblocks`)
+    sampling_rate : int
+        analysis sampling rate the file is resampled to (see `frame_params`)
+
+    Returns
+    ------
+    (hashes, init_times) : Tuple[ndarray, ndarray]
+        the packed hash of each fingerprint and the time of its anchor peak
+
+    Notes
+    -----
+    The blocks go straight through a `StreamingFingerprinter`, so only one block of
+    samples and a few spectrogram columns are held at a time. Its peak threshold is a
+    running percentile instead of the percentile of the whole spectrogram, so the
+    fingerprints can differ slightly from those of `sample_fingerprints`.
+    """
+    window_size, step = frame_params(sampling_rate)
+    fingerprinter = StreamingFingerprinter(window_size, step, amp_min_percentile = amp_min_percent, cutoff = cutoff,
+                                           fanoutsize = fanoutsize)
+    parts = [fingerprinter.feed(block) for block in fileblocks(filename, block_seconds, cliptime, sampling_rate)]
+    parts.append(fingerprinter.finish())
+    hashes, init_times = zip(*parts)
+    return np.concatenate(hashes), np.concatenate(init_times)
+
+def cached_file_fingerprints(filename, cache, cliptime = None, amp_min_percent = 75, cutoff = 20, fanoutsize = 15,
+                             streaming = False, sampling_rate = 44100, peaks_per_column = None, bands = None,
+                             target_zone = None):
+    """
+    Same as fingerprinting `filesample(filename, cliptime, sampling_rate)` with `sample_fingerprints`
+    (or `file_fingerprints` if `streaming`), reusing the results of every stage whose
+    inputs did not change
+
+    Parameters
+    ----------
+    filename : string
+        file name of audio file to be analyzed
+    cache : FingerprintCache
+        cache of the decoded samples, peaks and fingerprints, keyed by the contents of the
+        file and the parameters of each stage
+    peaks_per_column, bands, target_zone
+        peak budget per spectrogram column (see `local_peak_locations`) and target zone
+        (see `sample_fingerprints`); not supported with `streaming`
+
+    Returns
+    ------
+    (hashes, init_times) : Tuple[ndarray, ndarray]
+        the packed hash of each fingerprint and the time of its anchor peak
+    """
+    settings = _fingerprint_settings({}, peaks_per_column = peaks_per_column, bands = bands, target_zone = target_zone)
+    if streaming and any(value is not None for value in settings.values()):
+        raise ValueError("Streaming fingerprinting does not support a peak budget or a target zone")
+    digest = file_digest(filename)
+    samples_params = {"cliptime": cliptime, "sampling_rate": sampling_rate}
+    target_zone = settings.pop("target_zone")
+    peaks_params = dict(samples_params, amp_min_percent = amp_min_percent, cutoff = cutoff, **settings)
+    hashes_params = dict(peaks_params, fanoutsize = fanoutsize, streaming = streaming, target_zone = target_zone)
+
+    cached = cache.get("hashes", digest, hashes_params)
+    if cached is not None:
+        return tuple(cached)
+
+    if streaming:
+        # the streaming path never holds the samples or the spectrogram
+        hashes, init_times = file_fingerprints(filename, cliptime, amp_min_percent, cutoff, fanoutsize,
+                                               sampling_rate = sampling_rate)
+    else:
+        cached = cache.get("peaks", digest, peaks_params)
+        if cached is not None:
+            peakindices = cached[0]
+        else:
+            cached = cache.get("samples", digest, samples_params)
+            if cached is not None:
+                samples = cached[0]
+            else:
+                samples, _ = filesample(filename, cliptime, sampling_rate)
+                cache.put("samples", digest, samples_params, [samples])
+            spec = make_spectogram(samples, None, *frame_params(sampling_rate))
+            peakindices = local_peak_locations(spec, amp_min_percent, cutoff, **settings)
+            cache.put("peaks", digest, peaks_params, [peakindices])
+        hashes, init_times = _pair_peaks(peakindices, fanoutsize, target_zone)
+
+    cache.put("hashes", digest, hashes_params, [hashes, init_times])
+    return hashes, init_times
+
+def query_many(clips, fingerprint_database, artist_database, amp_min_percent = 75, cutoff = 20, fanoutsize = 15,
+               sampling_rate = None, peaks_per_column = None, bands = None, target_zone = None, min_score = 2.0):
+    """
+    Recognizes many clips in one call
+
+    Parameters
+    ----------
+    clips : List[ndarray]
+        the shape-(N,) array of samples of each clip
+    fingerprint_database : Union[FingerprintIndex, ShardedIndex]
+        database of the fingerprints
+    artist_database : Dict
+        database that maps songid to artist name and song name
+    sampling_rate : Optional[int]
+        sampling rate of the clips, defaults to that of the database
+    peaks_per_column, bands, target_zone
+        peak budget per spectrogram column (see `local_peak_locations`) and target zone
+        (see `sample_fingerprints`), default to those of the database (different ones
+        raise ValueError)
+    min_score : float
+        score below which a clip is considered not to match (see `match_many`)
+
+    Returns
+    ------
+    List[Tuple(string, string)]
+        the artist & song name guessed by wahzam for each clip, empty if nothing matched
+
+    Notes
+    -----
+    Clips of equal length share one stacked `make_spectogram` call (one batched rfft);
+    the fingerprints of all clips are then looked up and voted on at once by `match_many`.
+    """
+    window_size, step = frame_params(_analysis_rate(fingerprint_database, sampling_rate))
+    settings = _fingerprint_settings(fingerprint_database, peaks_per_column = peaks_per_column, bands = bands,
+                                     target_zone = target_zone)
+    target_zone = settings.pop("target_zone")
+    hash_lists = [None] * len(clips)
+    time_lists = [None] * len(clips)
+    lengths = np.array([len(clip) for clip in clips])
+    for length in np.unique(lengths):
+        same_length = np.flatnonzero(lengths == length)
+        spectrograms = make_spectogram(np.stack([clips[i] for i in same_length]), None, window_size, step)
+        for i, spectrogram in zip(same_length, spectrograms):
+            peak_indices = local_peak_locations(spectrogram, amp_min_percent, cutoff, **settings)
+            hash_lists[i], time_lists[i] = _pair_peaks(peak_indices, fanoutsize, target_zone)
+
+    matches = match_many(fingerprint_database, hash_lists, time_lists, min_score = min_score)
+    return [get_info(clip_matches[0][0], artist_database) if clip_matches else tuple() for clip_matches in matches]
+
+def song_info_from_path(file_path):
+    """
+    Guesses (song name, artist name) from an audio file name of the form
+    "<artist> - <song>.<ext>", using "Unknown" as the artist for other names
+    """
+    stem = pathlib.Path(file_path).stem
+    if " - " in stem:
+        artist, song = stem.split(" - ", 1)
+        return song.strip(), artist.strip()
+    return stem, "Unknown"
+
+def _fingerprint_file(file_path, cliptime, amp_min_percent, cutoff, fanoutsize, streaming = False, cache = None,
+                      sampling_rate = 44100, settings = None):
+    # Worker of `populate_database_from_folder`: returns (path, hashes, times, error);
+    # settings holds the FINGERPRINT_SETTINGS of the database
+    settings = settings or {}
+    try:
+        if cache is not None:
+            hashes, init_times = cached_file_fingerprints(file_path, cache, cliptime, amp_min_percent, cutoff,
+                                                          fanoutsize, streaming, sampling_rate, **settings)
+        elif streaming:
+            hashes, init_times = file_fingerprints(file_path, cliptime, amp_min_percent, cutoff, fanoutsize,
+                                                   sampling_rate = sampling_rate)
+        else:
+            samples, times = filesample(file_path, cliptime, sampling_rate)
+            hashes, init_times = sample_fingerprints(samples, times, amp_min_percent, cutoff, fanoutsize,
+                                                     sampling_rate = sampling_rate, **settings)
+    except Exception as e:
+        return file_path, None, None, f"{type(e).__name__}: {e}"
+    return file_path, hashes, init_times, None
+
+def populate_database_from_folder(foldername, database_directory, cliptime = None, amp_min_percent = 75, cutoff = 20,
+                                  fanoutsize = 15, workers = None, checkpoint_seconds = 60, retry_failed = False,
+                                  streaming = False, cache = None, sampling_rate = None, peaks_per_column = None,
+                                  bands = None, target_zone = None):
+    """
+    Populates an on-disk database with every audio file in a folder, fingerprinting
+    the files in parallel worker processes
+
+    Parameters
+    ----------
+    foldername : string
+        folder containing the audio files (searched recursively, see `foldersample`)
+    database_directory : string
+        directory of the database (see `save_index`), created if it does not exist
+        and extended if it does
+    cliptime : Optional[float]
+        seconds of each file to fingerprint, None for the whole file
+    workers : Optional[int]
+        number of worker processes, defaults to the number of CPUs
+    checkpoint_seconds : float
+        minimum time between two saves of the index; the interval also grows to four
+        times the duration of the last save, so that saving a large index never takes
+        more than a fifth of the ingest time
+    retry_failed : bool
+        whether files that failed to decode in a previous run should be tried again
+    streaming : bool
+        whether to decode and fingerprint the files block by block (see `file_fingerprints`),
+        which bounds the memory used per file
+    cache : Optional[FingerprintCache]
+        cache of the decoded samples, peaks and fingerprints of the files, so that a rerun
+        with other parameters (or after a crash) only redoes the stages that changed
+        (see `cached_file_fingerprints`)
+    sampling_rate : Optional[int]
+        analysis sampling rate of a new database (see `frame_params`), 44100 by default;
+        an existing database keeps its own, which this must agree with if given
+    peaks_per_column, bands, target_zone
+        peak budget per spectrogram column (see `local_peak_locations`) and target zone
+        (see `sample_fingerprints`) of a new database, recorded in its header; an existing
+        database keeps its own, which these must agree with if given
+
+    Returns
+    ------
+    (fingerprint_index, artist_database) : Tuple[FingerprintIndex, Dict]
+        the populated databases
+
+    Notes
+    -----
+    Song and artist names come from the file names (see `song_info_from_path`).
+
+    Every file is recorded in database_directory/ingest_log.jsonl, with its error if it
+    failed to decode, and each save of the index records how many log entries it covers.
+    Running the function again on the same folder resumes from the entries covered by the
+    last save (later ones, written just before a crash, are dropped), so every file is
+    ingested exactly once.
+    """
+    database_directory = pathlib.Path(database_directory)
+    database_directory.mkdir(parents = True, exist_ok = True)
+    log_path = database_directory / "ingest_log.jsonl"
+    log_lines = []
+    if log_path.exists():
+        with open(log_path) as log_file:
+            log_lines = log_file.readlines()
+    if (database_directory / "header.json").exists():
+        fingerprint_index, artist_database = load_index(database_directory)
+        sampling_rate = _analysis_rate(fingerprint_index, sampling_rate)
+        settings = _fingerprint_settings(fingerprint_index, peaks_per_column = peaks_per_column, bands = bands,
+                                         target_zone = target_zone)
+        with open(database_directory / "header.json") as opened_file:
+            metadata = json.load(opened_file).get("metadata", {})
+        # entries logged after the last save belong to songs the saved index does not hold
+        log_lines = log_lines[:metadata.get("ingest_log_entries", len(log_lines))]
+    else:
+        sampling_rate = _analysis_rate({}, sampling_rate)
+        fingerprint_index = FingerprintIndex(sampling_rate = sampling_rate, peaks_per_column = peaks_per_column,
+                                             bands = bands, target_zone = target_zone)
+        artist_database, log_lines = {}, []
+        settings = _fingerprint_settings(fingerprint_index)
+    if streaming and any(value is not None for value in settings.values()):
+        raise ValueError("Streaming fingerprinting does not support a peak budget or a target zone")
+    with open(log_path, mode = "w") as log_file:
+        log_file.writelines(line if line.endswith("\n") else line + "\n" for line in log_lines)
+    logged = len(log_lines)
+
+    done = set()
+    for line in log_lines:
+        entry = json.loads(line)
+        if entry["error"] is None or not retry_failed:
+            done.add(entry["path"])
+    file_paths = [f for f in foldersample(foldername) if f not in done]
+
+    def checkpoint(entries):
+        # log first, then save the index recording how many log entries it covers
+        nonlocal logged
+        with open(log_path, mode = "a") as log_file:
+            log_file.writelines(json.dumps(entry) + "\n" for entry in entries)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        logged += len(entries)
+        save_index(fingerprint_index, artist_database, database_directory, metadata = {"ingest_log_entries": logged})
+
+    total = len(file_paths)
+    workers = workers or os.cpu_count()
+    remaining = iter(file_paths)
+    pending = set()
+    batch_log = []
+    count = 0
+    last_save = time.perf_counter()
+    save_interval = checkpoint_seconds
+    with ProcessPoolExecutor(max_workers = workers, initializer = warm_start) as executor:
+        while True:
+            # keep a bounded number of files in flight so finished hash arrays do not pile up
+            for file_path in remaining:
+                pending.add(executor.submit(_fingerprint_file, file_path, cliptime, amp_min_percent, cutoff, fanoutsize,
+                                               streaming, cache, sampling_rate, settings))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in finished:
+                count += 1
+                file_path, hashes, init_times, error = future.result()
+                if error is None:
+                    name, artist = song_info_from_path(file_path)
+                    add_song(hashes, init_times, name, artist, artist_database, fingerprint_index)
+                    print(f"[{count}/{total}] {file_path}")
+                else:
+                    print(f"[{count}/{total}] FAILED {file_path}: {error}")
+                batch_log.append({"path": file_path, "error": error})
+
+                if count == total or time.perf_counter() - last_save >= save_interval:
+                    start = time.perf_counter()
+                    checkpoint(batch_log)
+                    batch_log = []
+                    last_save = time.perf_counter()
+                    save_interval = max(checkpoint_seconds, 4 * (last_save - start))
+    if total == 0:
+        checkpoint([])
+    return fingerprint_index, artist_database
+
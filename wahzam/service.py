@@ -0,0 +1,281 @@
+# Long-running recognition service: the database is loaded once and recognition requests
+# are served over a local HTTP (TCP or Unix socket) server.
+#
+#   python -m wahzam.service path/to/database --port 8000
+#   curl -H "Content-Type: audio/x-float32" --data-binary @clip.f32 http://127.0.0.1:8000/recognize
+#   curl -H "Content-Type: audio/L16; rate=16000" --data-binary @clip.s16 http://127.0.0.1:8000/recognize
+#
+# The CPU-bound spectrogram/peak/fingerprint stages run in a process pool, and the hash
+# lookups of requests that arrive close together are micro-batched into one `match_many` call.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .databases import _fingerprint_settings, get_info, load_index, match_many
+from .digital_sampling import resample
+from .find_peaks import warm_start
+from .main_functions import sample_fingerprints
+from .shards import ShardedIndex
+
+# sample formats accepted in the Content-Type of a /recognize request; bodies that are not
+# labelled as audio are read as float32, and clips without a "rate" parameter as 44100 Hz
+SAMPLE_FORMATS = {"audio/l16": "<i2", "audio/x-int16": "<i2", "audio/x-float32": "<f4"}
+
+
+def _clip_hashes(samples, clip_rate, sampling_rate, settings, amp_min_percent, cutoff, fanoutsize):
+    # Worker of `RecognitionService`: resamples the clip to the database's rate and fingerprints
+    # it with the database's FINGERPRINT_SETTINGS
+    samples = resample(samples, clip_rate, sampling_rate)
+    return sample_fingerprints(samples, None, amp_min_percent, cutoff, fanoutsize, sampling_rate = sampling_rate,
+                               **settings)
+
+
+class RecognitionService:
+    """
+    Recognizes clips against a resident database.
+
+    Every clip is fingerprinted in a worker process, then queued for matching. The matcher
+    waits up to `batch_window` seconds after the first queued clip for others (at most
+    `max_batch`) and matches all of them with one `match_many` call.
+
+    Parameters
+    ----------
+    fingerprint_database : Union[FingerprintIndex, ShardedIndex]
+        database of the fingerprints
+    artist_database : dict
+        database that maps songid to artist name and song name
+    workers : Optional[int]
+        number of fingerprinting worker processes, defaults to the number of CPUs
+    min_score : float
+        score below which a clip is answered with no song (see `match_many`)
+    max_body_bytes : int
+        largest request body accepted; larger ones are answered with 413 without being read
+    """
+
+    def __init__(self, fingerprint_database, artist_database, workers = None, batch_window = 0.005,
+                 max_batch = 64, amp_min_percent = 75, cutoff = 20, fanoutsize = 15, min_score = 2.0,
+                 max_body_bytes = 64 * 2**20):
+        self.fingerprint_database = fingerprint_database
+        self.artist_database = artist_database
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.min_score = min_score
+        self.max_body_bytes = max_body_bytes
+        self.sampling_rate = getattr(fingerprint_database, "sampling_rate", 44100)
+        self.settings = _fingerprint_settings(fingerprint_database)
+        self.fingerprint_params = (amp_min_percent, cutoff, fanoutsize)
+        # the pool starts its workers lazily, once the event loop already runs threads (the
+        # default executor), and a worker forked from a threaded process can deadlock
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+        self.executor = ProcessPoolExecutor(max_workers = workers, initializer = warm_start,
+                                            mp_context = multiprocessing.get_context(start_method))
+        self._queue = None
+        self._matcher = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._matcher = asyncio.create_task(self._match_batches())
+
+    async def stop(self):
+        self._matcher.cancel()
+        # shutting the pool down waits for its workers, which must not block the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def recognize(self, samples, clip_rate = 44100):
+        """
+        Recognizes one clip
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+            the audio samples of the clip
+        clip_rate : int
+            sampling rate of the clip, resampled to the database's rate if different
+
+        Returns
+        -------
+        Optional[Tuple[Tuple(string, string), int, int]]
+            (song info, votes, offset) of the best match, None if nothing matched
+        """
+        loop = asyncio.get_running_loop()
+        hashes, init_times = await loop.run_in_executor(self.executor, _clip_hashes, samples, clip_rate,
+                                                        self.sampling_rate, self.settings,
+                                                        *self.fingerprint_params)
+        result = loop.create_future()
+        await self._queue.put((hashes, init_times, result))
+        return await result
+
+    async def _match_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            hash_lists = [item[0] for item in batch]
+            time_lists = [item[1] for item in batch]
+            try:
+                # the lookup itself is vectorized NumPy, run it off the event loop
+                matches = await loop.run_in_executor(None, match_many, self.fingerprint_database, hash_lists, time_lists,
+                                                     1, self.min_score)
+            except Exception as e:
+                for item in batch:
+                    if not item[2].done():
+                        item[2].set_exception(e)
+                continue
+            for item, clip_matches in zip(batch, matches):
+                # the request may have been cancelled (e.g. its client disconnected) meanwhile
+                if item[2].done():
+                    continue
+                if clip_matches:
+                    song_id, votes, offset = clip_matches[0]
+                    item[2].set_result((get_info(song_id, self.artist_database), votes, offset))
+                else:
+                    item[2].set_result(None)
+
+    async def handle_connection(self, reader, writer):
+        """Serves the HTTP requests of one connection (see `_handle_request`)"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                malformed = len(parts) != 3
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    if ":" not in line:
+                        malformed = True
+                        continue
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get("content-length", "0")
+                if malformed or not length.isdigit():
+                    # the request cannot be delimited, so the connection cannot be reused
+                    await self._respond(writer, "400 Bad Request", {"error": "malformed request"})
+                    break
+                if int(length) > self.max_body_bytes:
+                    # the body is left unread, so the connection cannot be reused either
+                    await self._respond(writer, "413 Payload Too Large",
+                                        {"error": f"body larger than {self.max_body_bytes} bytes"})
+                    break
+                body = await reader.readexactly(int(length))
+
+                method, path, _ = parts
+                try:
+                    status, response = await self._handle_request(method, path, headers, body)
+                except ValueError as e:
+                    # a clip that cannot be decoded or fingerprinted
+                    status, response = "400 Bad Request", {"error": str(e)}
+                except Exception as e:
+                    status, response = "500 Internal Server Error", {"error": f"{type(e).__name__}: {e}"}
+                await self._respond(writer, status, response)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, response):
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+        await writer.drain()
+
+    async def _handle_request(self, method, path, headers, body):
+        # GET /health, or POST /recognize with the raw little-endian mono samples as the body
+        if method == "GET" and path == "/health":
+            return "200 OK", {"status": "ok", "songs": len(self.artist_database)}
+        if method != "POST" or path != "/recognize":
+            return "404 Not Found", {"error": f"{method} {path} is not served"}
+
+        content_type, *type_params = [part.strip() for part in headers.get("content-type", "").split(";")]
+        content_type = content_type.lower()
+        if content_type.startswith("audio/") and content_type not in SAMPLE_FORMATS:
+            return "415 Unsupported Media Type", {"error": f"expected one of {sorted(SAMPLE_FORMATS)}"}
+        type_params = dict(param.lower().split("=", 1) for param in type_params if "=" in param)
+        clip_rate = type_params.get("rate", "44100").strip('"')
+        if not clip_rate.isdigit() or int(clip_rate) == 0:
+            return "400 Bad Request", {"error": f"invalid sampling rate {clip_rate!r}"}
+        dtype = np.dtype(SAMPLE_FORMATS.get(content_type, "<f4"))
+        if len(body) % dtype.itemsize:
+            return "400 Bad Request", {"error": f"body is not a whole number of {dtype.itemsize}-byte samples"}
+        samples = np.frombuffer(body, dtype=dtype).astype(np.float32)
+        match = await self.recognize(samples, int(clip_rate))
+        if match is None:
+            return "200 OK", {"song": None}
+        (song, artist), votes, offset = match
+        return "200 OK", {"song": song, "artist": artist, "votes": votes, "offset": offset}
+
+
+def load_database(directory):
+    """
+    Opens a saved database, sharded (`ShardedIndex.save`) or not (`save_index`)
+    """
+    if (pathlib.Path(directory) / "shards.json").exists():
+        return ShardedIndex.load(directory)
+    return load_index(directory)
+
+
+async def serve(service, host = "127.0.0.1", port = 8000, unix_path = None):
+    """Runs the service until cancelled, on a Unix socket if `unix_path` is given"""
+    await service.start()
+    if unix_path is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, path = unix_path)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Serve song recognition requests from a resident database")
+    parser.add_argument("database", help = "database directory (see save_index / ShardedIndex.save)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("--unix", help = "serve on this Unix socket path instead of TCP")
+    parser.add_argument("--workers", type = int, help = "fingerprinting worker processes")
+    parser.add_argument("--batch-window", type = float, default = 0.005,
+                        help = "seconds to wait for more requests to batch lookups with")
+    parser.add_argument("--max-body-bytes", type = int, default = 64 * 2**20,
+                        help = "largest clip accepted, in bytes")
+    args = parser.parse_args(args)
+
+    fingerprint_database, artist_database = load_database(args.database)
+    if isinstance(fingerprint_database, ShardedIndex):
+        # every batched lookup then goes to the shard worker processes
+        fingerprint_database.start_workers()
+    service = RecognitionService(fingerprint_database, artist_database, workers = args.workers,
+                                 batch_window = args.batch_window, max_body_bytes = args.max_body_bytes)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if isinstance(fingerprint_database, ShardedIndex):
+            fingerprint_database.stop_workers()
+
+
+if __name__ == "__main__":
+    main()
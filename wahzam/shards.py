@@ -0,0 +1,279 @@
+# Hash-partitioned fingerprint database: the fingerprint keys are split across several
+# FingerprintIndex shards, and queries are scattered to the shards holding their keys and
+# gathered back by adding up the partial (song, offset) votes.
+
+import json
+import multiprocessing
+import pathlib
+import threading
+
+import numpy as np
+
+from .databases import (FINGERPRINT_SETTINGS, FingerprintIndex, _index_settings, _setting_value,
+                        as_hashes, best_matches, load_index, merge_offset_histograms, offset_histogram, save_index)
+
+
+def shard_of(hashes, num_shards):
+    """
+    Returns the shard of each packed hash key
+
+    Parameters
+    ----------
+    hashes: numpy.ndarray[uint64]
+        packed hash keys
+    num_shards: int
+        number of shards
+
+    Returns
+    -------
+    numpy.ndarray[int64]
+        shard number of each key
+
+    Notes
+    -----
+    The keys are mixed with a multiplicative (Fibonacci) hash first, so that shards stay
+    balanced even though neighboring keys share their high bits.
+    """
+    mixed = np.asarray(hashes, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return ((mixed >> np.uint64(32)) % np.uint64(num_shards)).astype(np.int64)
+
+
+def shard_votes(fingerprint_index, hashes, abs_times):
+    """
+    Partial offset histogram (see `offset_histogram`) of the query hashes held by one shard
+    """
+    abs_times = np.asarray(abs_times, dtype=np.int64)
+    query_positions, song_indices, times = fingerprint_index.lookup_many(hashes)
+    return offset_histogram(song_indices, times - abs_times[query_positions])
+
+
+def _shard_worker(conn, directory):
+    # Serves one shard, memory-mapped from `directory`, until it receives "stop"
+    fingerprint_index, _ = load_index(directory)
+    while True:
+        request = conn.recv()
+        if request[0] == "stop":
+            break
+        if request[0] == "lookup":
+            conn.send(fingerprint_index.lookup_many(request[1]))
+        else:
+            _, hashes, abs_times = request
+            conn.send(shard_votes(fingerprint_index, hashes, abs_times))
+    conn.close()
+
+
+class ShardedIndex:
+    """
+    A fingerprint database split into `num_shards` FingerprintIndex shards by key hash
+    (see `shard_of`).
+
+    Every song is registered in every shard in the same order, so a song has the same song
+    index in all of the shards and the partial votes of the shards can simply be added up.
+
+    By default the shards are queried in-process. After `save`, `start_workers` moves every
+    shard into its own worker process (each memory-mapping its saved shard), and queries
+    send each worker only the query hashes that belong to its shard; this covers both
+    `match` and `lookup_many`, so `match_scored`, `match_many` and `give_matched_songid`
+    use the workers too.
+
+    Can be passed anywhere a FingerprintIndex is accepted. `max_postings`, `cap_postings`,
+    `sampling_rate` and the fingerprint settings (`peaks_per_column`, `bands`, `target_zone`)
+    are passed to every shard (see `FingerprintIndex`); since all the postings of a key are
+    in the same shard, the shards stop-list the same keys an unsharded index would.
+    """
+
+    def __init__(self, num_shards = 4, max_postings = None, cap_postings = False, sampling_rate = 44100,
+                 peaks_per_column = None, bands = None, target_zone = None):
+        self.shards = [FingerprintIndex(max_postings, cap_postings, sampling_rate, peaks_per_column, bands, target_zone)
+                       for _ in range(num_shards)]
+        self.sampling_rate = sampling_rate
+        self.peaks_per_column = _setting_value(peaks_per_column)
+        self.bands = _setting_value(bands)
+        self.target_zone = _setting_value(target_zone)
+        self.directory = None
+        self._workers = []
+        # one round trip to the workers at a time, the pipes are shared by all threads
+        self._workers_lock = threading.Lock()
+
+    @classmethod
+    def from_index(cls, fingerprint_index, num_shards = 4):
+        """Splits a FingerprintIndex into `num_shards` shards"""
+        sharded = cls(num_shards, fingerprint_index.max_postings, fingerprint_index.cap_postings,
+                      fingerprint_index.sampling_rate, **_index_settings(fingerprint_index))
+        fingerprint_index.flush()
+        hashes = np.repeat(fingerprint_index.keys, np.diff(fingerprint_index.offsets))
+        shard_numbers = shard_of(hashes, num_shards)
+        stopped_shards = shard_of(fingerprint_index.stopped_keys, num_shards)
+        if sharded.shards:
+            # the postings stop-listed so far are not attributable to a shard
+            sharded.shards[0].stopped_postings = fingerprint_index.stopped_postings
+        for i, shard in enumerate(sharded.shards):
+            shard._set_song_ids(fingerprint_index.song_ids, fingerprint_index._uncompacted)
+            shard.stopped_keys = fingerprint_index.stopped_keys[stopped_shards == i]
+            in_shard = shard_numbers == i
+            shard.add_many(hashes[in_shard], fingerprint_index.times[in_shard], fingerprint_index.song_indices[in_shard])
+        return sharded
+
+    @property
+    def num_shards(self):
+        return len(self.shards)
+
+    @property
+    def song_ids(self):
+        return self.shards[0].song_ids
+
+    @property
+    def nbytes(self):
+        return sum(shard.nbytes for shard in self.shards)
+
+    @property
+    def stopped_postings(self):
+        return sum(shard.stopped_postings for shard in self.shards)
+
+    @property
+    def skipped_lookups(self):
+        """Query hashes skipped by the in-process shards (workers count theirs in their own process)"""
+        return sum(shard.skipped_lookups for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, fingerprint):
+        key = as_hashes([fingerprint])
+        return fingerprint in self.shards[shard_of(key, self.num_shards)[0]]
+
+    def song_index(self, song_id):
+        """Returns the int index of `song_id`, registering the song in every shard if it is new"""
+        indices = {shard.song_index(song_id) for shard in self.shards}
+        assert len(indices) == 1
+        return indices.pop()
+
+    def add(self, fingerprints, abs_times, song_id):
+        """Adds the fingerprints of one song (see `FingerprintIndex.add`)"""
+        hashes = as_hashes(fingerprints)
+        abs_times = np.asarray(abs_times, dtype=np.int32)
+        shard_numbers = shard_of(hashes, self.num_shards)
+        for i, shard in enumerate(self.shards):
+            in_shard = shard_numbers == i
+            shard.add(hashes[in_shard], abs_times[in_shard], song_id)
+
+    def delete(self, song_id):
+        """Deletes a song from every shard (see `FingerprintIndex.delete`)"""
+        for shard in self.shards:
+            shard.delete(song_id)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def compact(self):
+        for shard in self.shards:
+            shard.compact()
+
+    def lookup(self, fingerprint):
+        """Same as `FingerprintIndex.lookup`, asking only the shard that holds the key"""
+        key = as_hashes([fingerprint])
+        return self.shards[shard_of(key, self.num_shards)[0]].lookup(key[0])
+
+    def lookup_many(self, hashes):
+        """Same as `FingerprintIndex.lookup_many`, with every shard looking up its own keys"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        shard_numbers = shard_of(hashes, self.num_shards)
+        slices = [np.flatnonzero(shard_numbers == i) for i in range(self.num_shards)]
+        with self._workers_lock:
+            if self._workers:
+                for (_, conn), positions in zip(self._workers, slices):
+                    conn.send(("lookup", hashes[positions]))
+                parts = [conn.recv() for _, conn in self._workers]
+            else:
+                parts = [shard.lookup_many(hashes[positions]) for shard, positions in zip(self.shards, slices)]
+        results = [(positions[query_positions], song_indices, times)
+                   for positions, (query_positions, song_indices, times) in zip(slices, parts)]
+        return tuple(np.concatenate(columns) for columns in zip(*results))
+
+    def _votes(self, hashes, abs_times):
+        # scatter the query hashes to their shards and gather the partial histograms
+        shard_numbers = shard_of(hashes, self.num_shards)
+        slices = [np.flatnonzero(shard_numbers == i) for i in range(self.num_shards)]
+        with self._workers_lock:
+            if self._workers:
+                for (_, conn), positions in zip(self._workers, slices):
+                    conn.send(("votes", hashes[positions], abs_times[positions]))
+                return [conn.recv() for _, conn in self._workers]
+        return [shard_votes(shard, hashes[positions], abs_times[positions])
+                for shard, positions in zip(self.shards, slices)]
+
+    def match(self, fingerprints, abs_times, top_k = 1):
+        """Same as `FingerprintIndex.match`, merging the partial votes of the shards"""
+        hashes = as_hashes(fingerprints)
+        abs_times = np.asarray(abs_times, dtype=np.int64)
+        histogram = merge_offset_histograms(self._votes(hashes, abs_times))
+        songs, votes, offsets = best_matches(*histogram, top_k=top_k)
+        return [(self.song_ids[s], v, o) for s, v, o in zip(songs.tolist(), votes.tolist(), offsets.tolist())]
+
+    def save(self, artist_database, directory):
+        """
+        Saves every shard with `save_index` into directory/shard<i>, along with a
+        shards.json header (the artist_database is stored with shard 0)
+        """
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for i, shard in enumerate(self.shards):
+            save_index(shard, artist_database if i == 0 else {}, directory / f"shard{i}")
+        with open(directory / "shards.json", mode = "w") as opened_file:
+            json.dump({"num_shards": self.num_shards}, opened_file)
+        self.directory = directory
+
+    @classmethod
+    def load(cls, directory, mmap_mode = "r"):
+        """
+        Opens a database saved by `ShardedIndex.save`, returning (sharded index, artist_database)
+        """
+        directory = pathlib.Path(directory)
+        with open(directory / "shards.json") as opened_file:
+            num_shards = json.load(opened_file)["num_shards"]
+        sharded = cls(0)
+        artist_database = {}
+        for i in range(num_shards):
+            shard, shard_artists = load_index(directory / f"shard{i}", mmap_mode)
+            sharded.shards.append(shard)
+            artist_database.update(shard_artists)
+        if sharded.shards:
+            sharded.sampling_rate = sharded.shards[0].sampling_rate
+            for name in FINGERPRINT_SETTINGS:
+                setattr(sharded, name, getattr(sharded.shards[0], name))
+        sharded.directory = directory
+        return sharded, artist_database
+
+    def start_workers(self):
+        """
+        Starts one worker process per shard, each serving the shard saved in `self.directory`
+
+        Notes
+        -----
+        The workers serve the saved shards: songs added or deleted afterwards are not seen
+        by queries until the index is saved again and the workers are restarted.
+        """
+        if self.directory is None:
+            raise RuntimeError("The sharded index must be saved before starting workers")
+        self.stop_workers()
+        with self._workers_lock:
+            for i in range(self.num_shards):
+                parent_conn, child_conn = multiprocessing.Pipe()
+                shard_directory = str(self.directory / f"shard{i}")
+                process = multiprocessing.Process(target=_shard_worker, args=(child_conn, shard_directory), daemon=True)
+                process.start()
+                # only the worker holds the child end, so its pipe reports EOF (instead of
+                # blocking the queries) if it dies
+                child_conn.close()
+                self._workers.append((process, parent_conn))
+
+    def stop_workers(self):
+        """Stops the worker processes, going back to in-process queries"""
+        with self._workers_lock:
+            for process, conn in self._workers:
+                if process.is_alive():
+                    conn.send(("stop",))
+                process.join()
+                conn.close()
+            self._workers = []
@@ -0,0 +1,302 @@
+# Streaming recognition: audio chunks are turned into spectrogram columns, peaks and
+# fingerprints as they arrive, and the votes are updated after every chunk so that a
+# match can be reported as soon as it is clear instead of after the whole recording.
+
+import numpy as np
+
+from .databases import _analysis_rate, _index_settings, get_info, offset_histogram, merge_offset_histograms, best_matches
+from .digital_sampling import frame_params
+from .find_peaks import _peaks, _amplitudes, get_window, neighborhood_offsets
+from .fingerprint import pack_fingerprints
+
+# log-amplitude range covered by the running percentile histogram (log(1e-20) is the floor
+# used by `local_peak_locations`)
+_LOG_MIN = np.log(1e-20)
+_LOG_MAX = 20.0
+_HISTOGRAM_BINS = 8192
+
+
+class StreamingPeakFinder:
+    """
+    Incremental version of `make_spectogram` + `local_peak_locations`.
+
+    Samples are split into windows of `window_size` samples every `step` samples, and every
+    window becomes one spectrogram column, computed as in `make_spectogram`. A column's
+    peaks are found once the `cutoff` columns after it exist, i.e. once its whole
+    neighborhood is known, so the peaks of a column are the same as the batch peak finder
+    would find for the same threshold.
+
+    Only the last `2 * cutoff + 1` columns are kept, so memory does not grow with the
+    length of the stream.
+
+    Notes
+    -----
+    The batch peak finder thresholds at a percentile of the whole spectrogram, which is not
+    known while streaming; here the percentile is taken over every column seen so far,
+    using a fixed-size histogram of log-amplitudes.
+    """
+
+    def __init__(self, window_size = 4096, step = 2048, window = "hann", amp_min_percentile = 75, cutoff = 20):
+        self.window_size = window_size
+        self.step = step
+        self.window = get_window(window, window_size)
+        self.amp_min_percentile = amp_min_percentile
+        self.cutoff = cutoff
+        self.rows, self.cols = neighborhood_offsets(cutoff)
+
+        self._samples = np.empty(0, dtype=np.float64)
+        self._columns = None          # log-amplitude columns, shape (F, n), first one is `_first_column`
+        self._first_column = 0
+        self._num_columns = 0         # total number of columns computed so far
+        self._num_final = 0           # columns whose peaks have been reported
+        self._histogram = np.zeros(_HISTOGRAM_BINS, dtype=np.int64)
+
+    def _amp_min(self):
+        cumulative = np.cumsum(self._histogram)
+        ind = min(round(cumulative[-1] * 0.01 * self.amp_min_percentile), cumulative[-1] - 1)
+        bin_index = np.searchsorted(cumulative, ind, side="right")
+        return _LOG_MIN + (bin_index + 1) * (_LOG_MAX - _LOG_MIN) / _HISTOGRAM_BINS
+
+    def _add_columns(self, samples):
+        self._samples = np.concatenate([self._samples, samples])
+        if len(self._samples) < self.window_size:
+            return
+        windowed_audio = np.lib.stride_tricks.sliding_window_view(self._samples, self.window_size)[::self.step]
+        self._samples = self._samples[len(windowed_audio) * self.step:]
+
+        # same columns as `make_spectogram`
+        log_columns = np.log(np.clip(_amplitudes(windowed_audio, self.window), 1e-20, None))
+
+        bins = ((log_columns - _LOG_MIN) * (_HISTOGRAM_BINS / (_LOG_MAX - _LOG_MIN))).astype(np.int64)
+        self._histogram += np.bincount(np.clip(bins, 0, _HISTOGRAM_BINS - 1).ravel(), minlength=_HISTOGRAM_BINS)
+
+        if self._columns is None:
+            self._columns = log_columns
+        else:
+            self._columns = np.concatenate([self._columns, log_columns], axis=1)
+        self._num_columns += log_columns.shape[1]
+
+    def _finalize(self, end):
+        # reports the peaks of columns [_num_final, end)
+        if end <= self._num_final:
+            return np.empty((0, 2), dtype=np.int64)
+        block_start = max(self._num_final - self.cutoff, self._first_column)
+        block = self._columns[:, block_start - self._first_column:]
+        peaks = np.array(_peaks(block, self.rows, self.cols, amp_min=self._amp_min()), dtype=np.int64).reshape(-1, 2)
+        peaks[:, 1] += block_start
+        peaks = peaks[(peaks[:, 1] >= self._num_final) & (peaks[:, 1] < end)]
+        self._num_final = end
+
+        # drop the columns that no later neighborhood reaches
+        keep_from = max(end - self.cutoff, self._first_column)
+        self._columns = self._columns[:, keep_from - self._first_column:]
+        self._first_column = keep_from
+        return peaks
+
+    def feed(self, samples):
+        """
+        Adds audio samples to the stream
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+            the next audio samples
+
+        Returns
+        -------
+        numpy.ndarray, shape-(P, 2)
+            (row, col) of the peaks that became final, in column-major order
+        """
+        self._add_columns(np.asarray(samples, dtype=np.float64).ravel())
+        return self._finalize(self._num_columns - self.cutoff)
+
+    def finish(self):
+        """
+        Ends the stream, returning the peaks of the last columns (whose neighborhoods
+        are cut off by the end of the stream)
+        """
+        if self._columns is None:
+            return np.empty((0, 2), dtype=np.int64)
+        return self._finalize(self._num_columns)
+
+
+class StreamingFingerprinter:
+    """
+    Incremental version of `sample_fingerprints`: audio chunks go through a
+    `StreamingPeakFinder`, and each new peak is paired with the `fanoutsize` peaks before
+    it, exactly as `fingerprint_hashes` pairs them.
+
+    Memory does not grow with the length of the stream apart from the returned hashes.
+    """
+
+    def __init__(self, window_size = 4096, step = 2048, window = "hann", amp_min_percentile = 75, cutoff = 20,
+                 fanoutsize = 15):
+        self.fanoutsize = fanoutsize
+        self.peak_finder = StreamingPeakFinder(window_size, step, window, amp_min_percentile, cutoff)
+        self._recent_peaks = np.empty((0, 2), dtype=np.int64)
+
+    def _pair(self, peaks):
+        # pair every new peak with the `fanoutsize` peaks before it
+        all_peaks = np.concatenate([self._recent_peaks, peaks])
+        partners = np.arange(len(self._recent_peaks), len(all_peaks))[:, None]
+        anchors = partners - np.arange(1, self.fanoutsize + 1)[None, :]
+        valid = anchors >= 0
+        partners = np.broadcast_to(partners, anchors.shape)[valid]
+        anchors = anchors[valid]
+        self._recent_peaks = all_peaks[-self.fanoutsize:]
+
+        init_times = all_peaks[anchors, 1]
+        hashes = pack_fingerprints(all_peaks[anchors, 0], all_peaks[partners, 0], all_peaks[partners, 1] - init_times)
+        return hashes, init_times.astype(np.int32)
+
+    def feed(self, samples):
+        """
+        Adds audio samples to the stream
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+            the next audio samples
+
+        Returns
+        -------
+        (hashes, init_times) : Tuple[ndarray, ndarray]
+            the packed hashes of the fingerprints that became final and the times of their anchor peaks
+        """
+        return self._pair(self.peak_finder.feed(samples))
+
+    def finish(self):
+        """Ends the stream, returning the fingerprints of the last peaks (see `feed`)"""
+        return self._pair(self.peak_finder.finish())
+
+
+class StreamingRecognizer:
+    """
+    Recognizes a song from audio chunks as they arrive.
+
+    Every chunk goes through a `StreamingFingerprinter`, and the new fingerprints are
+    looked up in the index and added to the running (song, offset) votes. `feed` returns
+    a match as soon as the leading song has at least `min_votes` votes and at least
+    `margin` times as many votes as the runner-up.
+
+    Parameters
+    ----------
+    fingerprint_index : FingerprintIndex
+        the database to match against, built with the same window_size/step/window
+    artist_database : dict
+        database that maps songid to artist name and song name
+    sampling_rate : Optional[int]
+        sampling rate of the audio, defaults to that of the database (a different one
+        raises ValueError)
+    window_size, step : Optional[int]
+        spectrogram frames, by default those of `frame_params(sampling_rate)`
+
+    Raises
+    ------
+    ValueError
+        if the database was fingerprinted with a peak budget or a target zone, which streaming
+        does not support
+    """
+
+    def __init__(self, fingerprint_index, artist_database, window_size = None, step = None, window = "hann",
+                 amp_min_percentile = 75, cutoff = 20, fanoutsize = 15, min_votes = 20, margin = 2.0,
+                 sampling_rate = None):
+        self.fingerprint_index = fingerprint_index
+        self.artist_database = artist_database
+        self.min_votes = min_votes
+        self.margin = margin
+        self.sampling_rate = _analysis_rate(fingerprint_index, sampling_rate)
+        unsupported = [name for name, value in _index_settings(fingerprint_index).items() if value is not None]
+        if unsupported:
+            raise ValueError(f"Streaming fingerprinting does not support the {', '.join(unsupported)} of the database")
+        default_window_size, default_step = frame_params(self.sampling_rate)
+        window_size = default_window_size if window_size is None else window_size
+        step = default_step if step is None else step
+        self.fingerprinter = StreamingFingerprinter(window_size, step, window, amp_min_percentile, cutoff, fanoutsize)
+
+        self._bin_songs = np.empty(0, dtype=np.int64)
+        self._bin_offsets = np.empty(0, dtype=np.int64)
+        self._bin_counts = np.empty(0, dtype=np.int64)
+
+    def _vote(self, hashes, init_times):
+        query_positions, song_indices, times = self.fingerprint_index.lookup_many(hashes)
+        if len(query_positions) == 0:
+            return
+
+        # merge the new votes into the running histogram
+        new_bins = offset_histogram(song_indices, times - init_times[query_positions])
+        running = (self._bin_songs, self._bin_offsets, self._bin_counts)
+        self._bin_songs, self._bin_offsets, self._bin_counts = merge_offset_histograms([running, new_bins])
+
+    def best(self, top_k = 1):
+        """
+        Returns the current (song id, votes, offset) of the top_k songs, ordered by decreasing votes
+        """
+        songs, votes, offsets = best_matches(self._bin_songs, self._bin_offsets, self._bin_counts, top_k)
+        song_ids = self.fingerprint_index.song_ids
+        return [(song_ids[s], v, o) for s, v, o in zip(songs.tolist(), votes.tolist(), offsets.tolist())]
+
+    def is_confident(self):
+        """Whether the leading song clears `min_votes` and leads the runner-up by `margin`"""
+        leaders = self.best(top_k = 2)
+        if not leaders or leaders[0][1] < self.min_votes:
+            return False
+        runner_up = leaders[1][1] if len(leaders) > 1 else 0
+        return leaders[0][1] >= self.margin * runner_up
+
+    def feed(self, samples):
+        """
+        Adds audio samples to the stream
+
+        Parameters
+        ----------
+        samples : numpy.ndarray, shape-(N,)
+            the next audio samples
+
+        Returns
+        -------
+        Optional[Tuple(string, string)]
+            the song info of the match once it is confident, otherwise None
+        """
+        self._vote(*self.fingerprinter.feed(samples))
+        if self.is_confident():
+            return get_info(self.best()[0][0], self.artist_database)
+        return None
+
+    def finish(self):
+        """
+        Ends the stream and returns the song info of the best match, or an empty tuple if
+        nothing matched confidently (see `is_confident`)
+        """
+        self._vote(*self.fingerprinter.finish())
+        if not self.is_confident():
+            return tuple()
+        return get_info(self.best()[0][0], self.artist_database)
+
+
+def recognize_stream(chunks, fingerprint_index, artist_database, **kwargs):
+    """
+    Recognizes a song from an iterable of audio chunks, stopping as soon as the match is confident
+
+    Parameters
+    ----------
+    chunks : Iterable[numpy.ndarray]
+        audio chunks in the order they were recorded
+    fingerprint_index : FingerprintIndex
+        the database to match against
+    artist_database : dict
+        database that maps songid to artist name and song name
+    **kwargs
+        passed to `StreamingRecognizer`
+
+    Returns
+    ------
+    Tuple(string, string)
+        the artist & song name guessed by wahzam, empty if nothing matched
+    """
+    recognizer = StreamingRecognizer(fingerprint_index, artist_database, **kwargs)
+    for chunk in chunks:
+        song_info = recognizer.feed(chunk)
+        if song_info is not None:
+            return song_info
+    return recognizer.finish()
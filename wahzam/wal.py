@@ -0,0 +1,333 @@
+# Write-ahead log for an on-disk database: instead of re-saving the whole index after every
+# change, every added or deleted song is appended to a log segment as one small record, and
+# the records are replayed on top of the last saved index when the database is opened.
+# A checkpoint saves the index (see `save_index`) and drops the segments it contains:
+#
+#   database = LoggedDatabase("path/to/database")
+#   add_song(hashes, times, name, artist, database.artist_database, database)   # one record
+#   delete_song(name, artist, database.artist_database, database)              # one record
+#   database.checkpoint(background = True)
+#
+# Directory layout, on top of the `save_index` files:
+#     wal/segment.<n>.log    records, each framed as
+#                            | json length (u32) | array bytes (u32) | crc32 (u32) | json | arrays |
+
+import json
+import os
+import pathlib
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from .databases import FingerprintIndex, _index_settings, as_hashes, load_index, save_index
+
+_FRAME = struct.Struct("<III")
+
+
+def _encode_record(record, hashes = None, times = None):
+    meta = json.dumps(record).encode()
+    arrays = b""
+    if hashes is not None:
+        arrays = np.ascontiguousarray(hashes, dtype="<u8").tobytes() + np.ascontiguousarray(times, dtype="<i4").tobytes()
+    payload = meta + arrays
+    return _FRAME.pack(len(meta), len(arrays), zlib.crc32(payload)) + payload
+
+
+def read_segment(path):
+    """
+    Reads the records of a log segment
+
+    Parameters
+    ----------
+    path: string
+        path of the segment
+
+    Returns
+    -------
+    (records, valid_bytes): Tuple[List[Tuple[dict, Optional[numpy.ndarray], Optional[numpy.ndarray]]], int]
+        the (record, hashes, times) of every complete record, and the length of the
+        segment up to the end of the last of them
+
+    Notes
+    -----
+    Reading stops at the first record that is truncated or fails its checksum, i.e. a
+    write that was interrupted by a crash.
+    """
+    data = pathlib.Path(path).read_bytes()
+    records = []
+    position = 0
+    while position + _FRAME.size <= len(data):
+        meta_length, array_length, checksum = _FRAME.unpack_from(data, position)
+        start = position + _FRAME.size
+        end = start + meta_length + array_length
+        if end > len(data) or zlib.crc32(data[start:end]) != checksum:
+            break
+        record = json.loads(data[start:start + meta_length])
+        hashes = times = None
+        if array_length:
+            count = array_length // 12
+            hashes = np.frombuffer(data, dtype="<u8", count=count, offset=start + meta_length)
+            times = np.frombuffer(data, dtype="<i4", count=count, offset=start + meta_length + 8 * count)
+        records.append((record, hashes, times))
+        position = end
+    return records, position
+
+
+class LoggedDatabase:
+    """
+    An on-disk database (a saved index plus a write-ahead log) that saves every change as
+    it is made, in time proportional to the size of the change
+
+    `add` and `delete` append one record (with the song's fingerprints, or just its id)
+    to the current log segment before changing the in-memory index, so after a crash
+    opening the database again replays every change that was logged. `checkpoint` saves
+    the index with `save_index` (in a background thread if asked to) and deletes the log
+    segments it now contains.
+
+    Parameters
+    ----------
+    directory: string
+        path of the database directory, created if needed; an existing `save_index`
+        database is opened and extended
+    sync: bool
+        whether to fsync every record, so that a change survives a power loss as soon
+        as `add`/`delete` return
+    segment_bytes: int
+        size above which a new log segment is started
+    checkpoint_bytes: Optional[int]
+        size of the log above which a background checkpoint is started automatically
+    sampling_rate: int
+        analysis sampling rate of a new database; an existing one keeps its own
+    peaks_per_column: Optional[int]
+    bands: Optional[Union[int, Sequence[int]]]
+        peak budget of a new database (see `FingerprintIndex`); an existing one keeps its own
+    target_zone: Optional[Tuple[int, int, int]]
+        target-zone pairing of a new database (see `FingerprintIndex`); an existing one keeps its own
+
+    Notes
+    -----
+    Can be passed anywhere a FingerprintIndex is accepted. Pass `artist_database` as the
+    artist_database of `add_song`/`delete_song`, so that the song info is logged too.
+    """
+
+    def __init__(self, directory, sync = True, segment_bytes = 64 * 2**20, checkpoint_bytes = None,
+                 sampling_rate = 44100, peaks_per_column = None, bands = None, target_zone = None):
+        self.directory = pathlib.Path(directory)
+        self.sync = sync
+        self.segment_bytes = segment_bytes
+        self.checkpoint_bytes = checkpoint_bytes
+        self.wal_directory = self.directory / "wal"
+        self.wal_directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._checkpointer = None
+
+        checkpoint_lsn = 0
+        if (self.directory / "header.json").exists():
+            self.index, self.artist_database = load_index(self.directory)
+            with open(self.directory / "header.json") as opened_file:
+                checkpoint_lsn = json.load(opened_file).get("metadata", {}).get("wal_lsn", 0)
+        else:
+            self.index = FingerprintIndex(sampling_rate=sampling_rate, peaks_per_column=peaks_per_column, bands=bands,
+                                          target_zone=target_zone)
+            self.artist_database = {}
+
+        # replay the records written after the last checkpoint
+        self.lsn = checkpoint_lsn
+        segments = self._segments()
+        for i, (number, path) in enumerate(segments):
+            records, valid_bytes = read_segment(path)
+            if valid_bytes < path.stat().st_size:
+                if i != len(segments) - 1:
+                    raise ValueError(f"Corrupt write-ahead log segment {path}")
+                # a torn write at the end of the log: drop it
+                with open(path, mode = "r+b") as opened_file:
+                    opened_file.truncate(valid_bytes)
+            for record, hashes, times in records:
+                if record["lsn"] > checkpoint_lsn:
+                    self._apply(record, hashes, times)
+                    self.lsn = record["lsn"]
+
+        self._segment_number = segments[-1][0] + 1 if segments else 0
+        self._log_bytes = sum(path.stat().st_size for _, path in segments)
+        self._segment = open(self.wal_directory / f"segment.{self._segment_number}.log", mode = "ab")
+
+    def _segments(self):
+        paths = self.wal_directory.glob("segment.*.log")
+        return sorted((int(path.name.split(".")[1]), path) for path in paths)
+
+    def _apply(self, record, hashes, times):
+        if record["op"] == "add":
+            if record["info"] is not None:
+                self.artist_database[record["song_id"]] = tuple(record["info"])
+            self.index.add(hashes, times, record["song_id"])
+        elif record["op"] == "delete":
+            self.artist_database.pop(record["song_id"], None)
+            self.index.delete(record["song_id"])
+
+    def _log(self, record, hashes = None, times = None):
+        # appends one record, starting a new segment when the current one is full
+        self.lsn += 1
+        data = _encode_record(dict(record, lsn=self.lsn), hashes, times)
+        if self._segment.tell() > 0 and self._segment.tell() + len(data) > self.segment_bytes:
+            self._roll()
+        self._segment.write(data)
+        self._segment.flush()
+        if self.sync:
+            os.fsync(self._segment.fileno())
+        self._log_bytes += len(data)
+
+    def _roll(self):
+        self._segment.close()
+        self._segment_number += 1
+        self._segment = open(self.wal_directory / f"segment.{self._segment_number}.log", mode = "ab")
+
+    def add(self, fingerprints, abs_times, song_id):
+        """Logs, then adds, the fingerprints of one song (see `FingerprintIndex.add`)"""
+        hashes = as_hashes(fingerprints)
+        times = np.asarray(abs_times, dtype=np.int32)
+        with self._lock:
+            info = self.artist_database.get(song_id)
+            self._log({"op": "add", "song_id": song_id, "info": list(info) if info is not None else None},
+                      hashes, times)
+            self.index.add(hashes, times, song_id)
+        self._maybe_checkpoint()
+
+    def delete(self, song_id):
+        """Logs, then applies, the deletion of a song (see `FingerprintIndex.delete`)"""
+        with self._lock:
+            if song_id not in self.index._song_lookup:
+                raise KeyError(song_id)
+            self._log({"op": "delete", "song_id": song_id})
+            self.index.delete(song_id)
+        self._maybe_checkpoint()
+
+    def _maybe_checkpoint(self):
+        if self.checkpoint_bytes is not None and self._log_bytes > self.checkpoint_bytes:
+            self.checkpoint(background = True)
+
+    def checkpoint(self, background = False):
+        """
+        Saves the index into the database directory and deletes the log segments it contains
+
+        Parameters
+        ----------
+        background: bool
+            whether to save in a background thread; `add`/`delete` only wait for the
+            in-memory snapshot of the index, not for the save
+
+        Returns
+        -------
+        Optional[threading.Thread]
+            the checkpointing thread if `background`, otherwise None
+
+        Notes
+        -----
+        The saved header records the last logged change it contains, so a crash at any
+        point of a checkpoint leaves a database that opens to the same state.
+        """
+        with self._lock:
+            if self._checkpointer is not None and self._checkpointer.is_alive():
+                return self._checkpointer
+            # new records go to a new segment, the older ones are all in the snapshot
+            self._roll()
+            merged_segments = [path for number, path in self._segments() if number < self._segment_number]
+            snapshot = self._snapshot()
+            artist_database = dict(self.artist_database)
+            lsn = self.lsn
+            self._log_bytes = 0
+
+        def save():
+            save_index(snapshot, artist_database, self.directory, metadata = {"wal_lsn": lsn})
+            for path in merged_segments:
+                path.unlink(missing_ok=True)
+
+        if not background:
+            save()
+            return None
+        self._checkpointer = threading.Thread(target=save, daemon=True)
+        self._checkpointer.start()
+        return self._checkpointer
+
+    def _snapshot(self):
+        # a copy of the index sharing its (never modified in place) arrays, stop-listed
+        # like the saved index will be
+        self.index._limit_postings()
+        snapshot = FingerprintIndex(self.index.max_postings, self.index.cap_postings, self.index.sampling_rate,
+                                    **_index_settings(self.index))
+        snapshot.keys = self.index.keys
+        snapshot.offsets = self.index.offsets
+        snapshot.song_indices = self.index.song_indices
+        snapshot.times = self.index.times
+        snapshot.stopped_keys = self.index.stopped_keys
+        snapshot.stopped_postings = self.index.stopped_postings
+        snapshot._set_song_ids(self.index.song_ids, self.index._uncompacted)
+        return snapshot
+
+    def close(self):
+        """Waits for a running checkpoint and closes the log"""
+        if self._checkpointer is not None:
+            self._checkpointer.join()
+        with self._lock:
+            self._segment.close()
+
+    @property
+    def song_ids(self):
+        return self.index.song_ids
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes
+
+    @property
+    def sampling_rate(self):
+        return self.index.sampling_rate
+
+    @property
+    def peaks_per_column(self):
+        return self.index.peaks_per_column
+
+    @property
+    def bands(self):
+        return self.index.bands
+
+    @property
+    def target_zone(self):
+        return self.index.target_zone
+
+    @property
+    def stopped_postings(self):
+        return self.index.stopped_postings
+
+    @property
+    def skipped_lookups(self):
+        return self.index.skipped_lookups
+
+    def __len__(self):
+        with self._lock:
+            return len(self.index)
+
+    def __contains__(self, fingerprint):
+        with self._lock:
+            return fingerprint in self.index
+
+    def flush(self):
+        with self._lock:
+            self.index.flush()
+
+    def compact(self):
+        with self._lock:
+            self.index.compact()
+
+    def lookup(self, fingerprint):
+        with self._lock:
+            return self.index.lookup(fingerprint)
+
+    def lookup_many(self, hashes):
+        with self._lock:
+            return self.index.lookup_many(hashes)
+
+    def match(self, fingerprints, abs_times, top_k = 1):
+        with self._lock:
+            return self.index.match(fingerprints, abs_times, top_k)